@@ -1,20 +1,25 @@
 import streamlit as st
 import os
 import sys
+import time
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
 from config.config import (
     PAGE_TITLE, PAGE_ICON, LAYOUT, MAX_CHAT_HISTORY,
-    RESPONSE_MODES, GROQ_API_KEY, TAVILY_API_KEY
+    RESPONSE_MODES, GROQ_API_KEY, TAVILY_API_KEY, INGEST_JOB_POLL_SECONDS
 )
 from models.llm import get_chatgroq_model, get_response_mode_instruction
-from models.embeddings import get_embedding_model
-from utils.document_processor import process_document, load_existing_vectorstore
+from models.embeddings import get_embedding_model, preload_embedding_models, get_embedding_memory_usage
+from utils.document_processor import list_documents, reset_knowledge_base, load_knowledge_base
+from utils.ingestion_jobs import (
+    submit_ingestion_job, submit_delete_job, get_job, cancel_job, forget_job, ACTIVE_STATUSES
+)
 from utils.retriever import retrieve_context
+from utils.context_builder import format_context_report, preload_token_counter
 from utils.web_search import search_web, should_use_web_search, format_search_for_context
 from utils.helpers import format_chat_history, get_cache_key, format_sources
-from utils.question_generator import generate_insightful_questions, generate_document_summary
+from utils.question_generator import generate_document_summary
 
 st.set_page_config(
     page_title=PAGE_TITLE,
@@ -23,6 +28,10 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Load the shared embedding model once per server process, without blocking the UI
+preload_embedding_models(background=True)
+preload_token_counter(background=True)
+
 def initialize_session_state():
     """Initialize all session state variables"""
     
@@ -41,9 +50,15 @@ def initialize_session_state():
     if "query_cache" not in st.session_state:
         st.session_state.query_cache = {}
     
+    if "search_filters" not in st.session_state:
+        st.session_state.search_filters = None
+    
     if "response_mode" not in st.session_state:
         st.session_state.response_mode = "Detailed"
     
+    if "context_report" not in st.session_state:
+        st.session_state.context_report = None
+    
     if "embeddings" not in st.session_state:
         try:
             st.session_state.embeddings = get_embedding_model()
@@ -56,17 +71,22 @@ def initialize_session_state():
     if "show_summary" not in st.session_state:
         st.session_state.show_summary = False
     
-    # Try to load existing FAISS index
+    if "ingestion_job" not in st.session_state:
+        st.session_state.ingestion_job = None
+    
+    # Try to load the existing knowledge base: FAISS, BM25 and chunks together
     if st.session_state.faiss_index is None:
         try:
-            loaded_vectorstore = load_existing_vectorstore()
+            loaded_vectorstore, loaded_bm25, loaded_docs = load_knowledge_base()
             if loaded_vectorstore:
                 st.session_state.faiss_index = loaded_vectorstore
+                st.session_state.bm25_index = loaded_bm25
+                st.session_state.corpus_docs = loaded_docs
         except Exception:
             pass
 
 def generate_response(query, response_mode):
-    cache_key = get_cache_key(f"{query}_{response_mode}")
+    cache_key = get_cache_key(f"{query}_{response_mode}_{st.session_state.search_filters}")
     if cache_key in st.session_state.query_cache:
         return st.session_state.query_cache[cache_key]
     
@@ -76,11 +96,13 @@ def generate_response(query, response_mode):
         rag_context = ""
         pages = []
         if st.session_state.faiss_index:
-            rag_context, pages = retrieve_context(
+            rag_context, pages, st.session_state.context_report = retrieve_context(
                 query,
                 st.session_state.faiss_index,
                 st.session_state.bm25_index,
-                st.session_state.corpus_docs
+                st.session_state.corpus_docs,
+                filters=st.session_state.search_filters,
+                response_mode=response_mode
             )
 
         web_results = None
@@ -126,6 +148,81 @@ Answer:"""
     except Exception as e:
         return f"Error generating response: {str(e)}"
 
+def apply_finished_ingestion_job():
+    """Swap in the result of a finished background ingestion job, if any."""
+    job_id = st.session_state.ingestion_job
+    if not job_id:
+        return
+    
+    job = get_job(job_id)
+    if job is None:
+        st.session_state.ingestion_job = None
+        return
+    
+    if job["status"] in ACTIVE_STATUSES:
+        return
+    
+    if job["status"] == "done":
+        result = job["result"]
+        # Replace all references together so queries never mix old and new indexes
+        st.session_state.faiss_index = result["vectorstore"]
+        st.session_state.bm25_index = result["bm25"]
+        st.session_state.corpus_docs = result["docs"]
+        st.session_state.query_cache = {}
+        if result["vectorstore"] is None:
+            st.session_state.suggested_questions = []
+        elif result["suggested_questions"]:
+            st.session_state.suggested_questions = result["suggested_questions"]
+        for message in job["messages"]:
+            st.toast(message)
+    elif job["status"] == "failed":
+        st.error(job["error"])
+    elif job["status"] == "cancelled":
+        st.warning("Document processing was cancelled")
+    
+    forget_job(job_id)
+    st.session_state.ingestion_job = None
+
+
+def ingestion_job_active():
+    job_id = st.session_state.ingestion_job
+    job = get_job(job_id) if job_id else None
+    return job is not None and job["status"] in ACTIVE_STATUSES
+
+
+UPLOAD_WINDOWS = {"Any time": None, "Last day": 1, "Last 7 days": 7, "Last 30 days": 30}
+
+
+def render_search_scope(documents):
+    """Let the user restrict retrieval to some documents, pages or upload dates"""
+    
+    with st.expander("Search Scope"):
+        names = {document["document_id"]: document["name"] for document in documents}
+        selected = st.multiselect(
+            "Documents", options=list(names), format_func=names.get,
+            help="Search only these documents (all when empty)"
+        )
+        col1, col2 = st.columns(2)
+        with col1:
+            first_page = st.number_input("From page", min_value=0, value=0, help="0 for the first page")
+        with col2:
+            last_page = st.number_input("To page", min_value=0, value=0, help="0 for the last page")
+        window = st.selectbox("Uploaded", options=list(UPLOAD_WINDOWS))
+        
+        filters = {}
+        if selected:
+            filters["document_ids"] = selected
+        if first_page or last_page:
+            filters["pages"] = (first_page or None, last_page or None)
+        if UPLOAD_WINDOWS[window]:
+            # Whole hours, so the filter stays the same between questions
+            filters["uploaded_after"] = (int(time.time()) // 3600 - UPLOAD_WINDOWS[window] * 24) * 3600
+        
+        st.session_state.search_filters = filters or None
+        if filters:
+            st.caption("Answers use only the matching chunks")
+
+
 def render_sidebar():
     """Render sidebar with controls"""
     
@@ -154,36 +251,69 @@ def render_sidebar():
         # Document Upload Section
         st.subheader("Knowledge Base")
         
-        uploaded_file = st.file_uploader(
-            "Upload Document",
+        uploaded_files = st.file_uploader(
+            "Upload Documents",
             type=["pdf"],
+            accept_multiple_files=True,
             help="Upload PDF files to add to knowledge base"
         )
         
-        if uploaded_file is not None:
-            if st.button("Process Document", type="primary", use_container_width=True):
-                with st.spinner("Processing document..."):
-                    try:
-                        vectorstore, bm25, docs, message = process_document(uploaded_file)
-                        
-                        st.session_state.faiss_index = vectorstore
-                        st.session_state.bm25_index = bm25
-                        st.session_state.corpus_docs = docs
-                        st.session_state.query_cache = {}
-                        
-                        # Generate insightful questions
-                        doc_content = "\n\n".join([doc.page_content for doc in docs[:20]])
-                        st.session_state.suggested_questions = generate_insightful_questions(doc_content, 3)
-                        
-                        st.success(message)
-                    
-                    except Exception as e:
-                        st.error(f"Error: {str(e)}")
+        job = get_job(st.session_state.ingestion_job) if st.session_state.ingestion_job else None
+        job_active = job is not None and job["status"] in ACTIVE_STATUSES
+        
+        if uploaded_files and not job_active:
+            if st.button("Process Documents", type="primary", use_container_width=True):
+                st.session_state.ingestion_job = submit_ingestion_job(uploaded_files, 3)
+                st.rerun()
+        
+        # Background job progress
+        if job_active and job["kind"] == "delete":
+            st.caption(f"{job['stage']}...")
+        elif job_active:
+            total_pages = job["total_pages"]
+            fraction = min(job["pages_extracted"] / total_pages, 1.0) if total_pages else 0.0
+            st.progress(
+                fraction,
+                text=f"{job['stage']}: {job['pages_extracted']}/{total_pages} pages extracted, "
+                     f"{job['chunks_embedded']} chunks embedded"
+            )
+            st.caption("You can keep chatting with the current knowledge base meanwhile")
+            if st.button("Cancel Processing", use_container_width=True):
+                cancel_job(job["job_id"])
+        
+        # List indexed documents
+        documents = list_documents()
+        if documents:
+            st.caption(f"{len(documents)} documents in knowledge base")
+            for document in documents:
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.caption(f"{document['name']} ({document['pages']} pages, {document['chunks']} chunks)")
+                with col2:
+                    if st.button("✕", key=f"delete_{document['document_id']}", help="Remove document",
+                                 disabled=job_active):
+                        # Queued behind any running ingestion, which would otherwise
+                        # save its copy of the knowledge base over the delete
+                        st.session_state.ingestion_job = submit_delete_job(
+                            document["document_id"], document["name"]
+                        )
+                        st.rerun()
+            
+            render_search_scope(documents)
         
         # Show RAG status
         if st.session_state.faiss_index:
             st.success("Knowledge base loaded")
-            st.caption(f"{len(st.session_state.corpus_docs)} chunks indexed")
+            shard_count = len(getattr(st.session_state.faiss_index, "shards", []))
+            shard_note = f" in {shard_count} shards" if shard_count > 1 else ""
+            st.caption(f"{len(st.session_state.corpus_docs)} chunks indexed{shard_note}")
+            if getattr(st.session_state.faiss_index, "memory_mapped", False):
+                st.caption("Vector index memory-mapped from disk (shared)")
+            embedding_bytes = sum(get_embedding_memory_usage().values())
+            if embedding_bytes:
+                st.caption(f"Embedding model memory: {embedding_bytes / (1024 * 1024):.0f} MB (shared)")
+            if st.session_state.context_report:
+                st.caption(format_context_report(st.session_state.context_report))
             
             # Summarize button
             st.divider()
@@ -207,12 +337,14 @@ def render_sidebar():
             st.session_state.query_cache = {}
             st.rerun()
         
-        if st.button("Reset Knowledge Base", use_container_width=True):
+        if st.button("Reset Knowledge Base", use_container_width=True, disabled=job_active):
+            reset_knowledge_base()
             st.session_state.faiss_index = None
             st.session_state.bm25_index = None
             st.session_state.corpus_docs = []
             st.session_state.query_cache = {}
             st.session_state.suggested_questions = []
+            st.session_state.search_filters = None
             st.success("Knowledge base reset")
             st.rerun()
 
@@ -386,6 +518,8 @@ def main():
             index=0
         )
 
+    apply_finished_ingestion_job()
+
     if page == "Chat":
         render_sidebar()
 
@@ -394,6 +528,11 @@ def main():
     else:
         render_instructions()
 
+    # Poll the background job; any user interaction interrupts the wait
+    if ingestion_job_active():
+        time.sleep(INGEST_JOB_POLL_SECONDS)
+        st.rerun()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,80 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from config.config import EMBEDDING_MODEL, CHUNK_SIZE
+from models.embeddings import get_embedding_model
+
+
+def load_texts(pdf_path, count):
+    """Chunk-sized texts from a PDF, or synthetic ones if no PDF is given."""
+    if pdf_path:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        from utils.ingestion_pipeline import iter_pdf_pages
+
+        splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=0)
+        texts = []
+        for page in iter_pdf_pages(pdf_path):
+            texts.extend(splitter.split_text(page.page_content))
+            if len(texts) >= count:
+                break
+        return texts[:count]
+
+    rng = random.Random(0)
+    words = ("retrieval document index vector query model latency memory throughput "
+             "search page chunk token answer context score rank embedding corpus").split()
+    return [
+        " ".join(rng.choice(words) for _ in range(rng.randint(20, 140)))
+        for _ in range(count)
+    ]
+
+
+def time_encode(model, texts, repeats):
+    model.embed_documents(texts[:8])  # warm up
+    best = float("inf")
+    vectors = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        vectors = model.embed_documents(texts)
+        best = min(best, time.perf_counter() - start)
+    return np.asarray(vectors, dtype=np.float32), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare PyTorch and ONNX Runtime embedding backends.")
+    parser.add_argument("--pdf", help="PDF to take chunk texts from (default: synthetic texts)")
+    parser.add_argument("--texts", type=int, default=512, help="Number of texts to encode")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per backend; the best is reported")
+    args = parser.parse_args()
+
+    texts = load_texts(args.pdf, args.texts)
+    print(f"Model: {EMBEDDING_MODEL}, {len(texts)} texts")
+
+    results = {}
+    for backend in ("torch", "onnx"):
+        model = get_embedding_model(EMBEDDING_MODEL, backend)
+        vectors, seconds = time_encode(model, texts, args.repeats)
+        results[backend] = vectors
+        print(f"{backend:>6}: {len(texts) / seconds:8.1f} texts/s ({seconds:.2f}s)")
+
+    # Both backends return unit vectors, so the dot product is the cosine
+    cosine = np.sum(results["torch"] * results["onnx"], axis=1)
+    print(f"Cosine similarity onnx vs torch: mean {cosine.mean():.4f}, min {cosine.min():.4f}")
+
+    # Agreement of nearest neighbours when onnx queries search a torch-built index
+    k = 8
+    queries = results["onnx"][:64]
+    exact = np.argsort(-(results["torch"][:64] @ results["torch"].T), axis=1)[:, :k]
+    mixed = np.argsort(-(queries @ results["torch"].T), axis=1)[:, :k]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(exact, mixed)])
+    print(f"Top-{k} overlap, onnx queries on torch index: {overlap:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from config.config import CHUNK_SIZE
+from utils.retriever import fuse_scores
+
+
+def make_results(rng, chunks, pool):
+    """Random FAISS and BM25 results over a corpus of the given size, half of them shared."""
+    shared = pool // 2
+    positions = rng.choice(chunks, size=2 * pool - shared, replace=False)
+    faiss_positions = positions[:pool]
+    bm25_positions = np.concatenate([positions[:shared], positions[pool:]])
+    faiss_distances = np.sort(rng.random(pool).astype(np.float32) * 2)
+    bm25_scores = np.sort(rng.random(pool) * 20)[::-1]
+    return faiss_positions, faiss_distances, bm25_positions, bm25_scores
+
+
+def dict_fusion(faiss_docs, bm25_docs, k):
+    """The previous fusion: a dict keyed by chunk text, sorted in full."""
+    max_bm25 = bm25_docs[0][1] if bm25_docs and bm25_docs[0][1] > 0 else 1
+    max_faiss = max(score for _, score in faiss_docs) if faiss_docs else 1
+    doc_scores = {}
+    for content, score in bm25_docs:
+        doc_scores[content] = {"bm25": score / max_bm25, "faiss": 0, "doc": content}
+    for content, score in faiss_docs:
+        similarity = 1 - (score / max_faiss) if max_faiss > 0 else 0
+        if content in doc_scores:
+            doc_scores[content]["faiss"] = similarity
+        else:
+            doc_scores[content] = {"bm25": 0, "faiss": similarity, "doc": content}
+    for content in doc_scores:
+        doc_scores[content]["combined"] = 0.4 * doc_scores[content]["bm25"] + 0.6 * doc_scores[content]["faiss"]
+    ranked = sorted(doc_scores.values(), key=lambda x: x["combined"], reverse=True)
+    return [item["doc"] for item in ranked[:k]]
+
+
+def chunk_text(position):
+    # Chunk-sized, distinct texts; made fresh for each run so their hashes are not cached
+    return f"{position:012d}" + "x" * (CHUNK_SIZE - 12)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time hybrid score fusion on chunk texts vs integer positions.")
+    parser.add_argument("--chunks", type=int, default=1_000_000, help="Corpus size")
+    parser.add_argument("--pools", default="8,100,10000,200000",
+                        help="Comma-separated numbers of candidates per retriever")
+    parser.add_argument("--k", type=int, default=8, help="Number of fused results")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed runs per pool size; the best is reported")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"Corpus: {args.chunks} chunks, k={args.k}")
+    for pool in (int(value) for value in args.pools.split(",")):
+        faiss_positions, faiss_distances, bm25_positions, bm25_scores = make_results(rng, args.chunks, pool)
+
+        dict_best = array_best = float("inf")
+        for _ in range(args.repeats):
+            # FAISS distances come back as float32 scalars
+            faiss_docs = [(chunk_text(p), d) for p, d in zip(faiss_positions.tolist(), faiss_distances)]
+            bm25_docs = [(chunk_text(p), s) for p, s in zip(bm25_positions.tolist(), bm25_scores.tolist())]
+            start = time.perf_counter()
+            expected = dict_fusion(faiss_docs, bm25_docs, args.k)
+            dict_best = min(dict_best, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            positions, _ = fuse_scores(faiss_positions, faiss_distances, bm25_positions, bm25_scores, args.k)
+            array_best = min(array_best, time.perf_counter() - start)
+
+        # Ties may be ordered differently, so compare the sets of results
+        agree = {chunk_text(p) for p in positions.tolist()} == set(expected)
+        print(f"{pool:>8} candidates: dict {dict_best * 1000:9.3f} ms, arrays {array_best * 1000:8.3f} ms "
+              f"({dict_best / array_best:6.1f}x), same results: {agree}")
+
+
+if __name__ == "__main__":
+    main()
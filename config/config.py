@@ -14,21 +14,76 @@ GROQ_TEMPERATURE = 0.1
 
 # RAG SETTINGS
 EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_BACKEND = "torch"  # "torch" or "onnx" (int8 ONNX Runtime, needs onnxruntime)
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_WORKERS = 0  # encoding processes for ingestion; 0 encodes in-process
+EMBEDDING_TOKEN_BUDGET = 8192  # max padded tokens per length-bucketed pool batch
+ONNX_MODEL_DIR = "models/onnx"  # exported ONNX models are cached here
+ONNX_QUANTIZE = True
 DB_FAISS_PATH = "vector_db/faiss_index"
+BM25_PATH = "vector_db/faiss_index/bm25"  # lexical index directory, saved with the vector store
+MANIFEST_PATH = "vector_db/manifest.json"
 CHUNK_SIZE = 800
 CHUNK_OVERLAP = 200
 RETRIEVAL_K = 8
+FAISS_CANDIDATES = 24  # chunks fetched from FAISS for fusion; at least RETRIEVAL_K
+BM25_CANDIDATES = 24  # chunks fetched from BM25 for fusion; at least RETRIEVAL_K
+FUSION_METHOD = "weighted"  # "weighted" (blend of max-normalized scores) or "rrf" (reciprocal rank fusion)
+FUSION_WEIGHTS = {"faiss": 0.6, "bm25": 0.4}  # weight of each retriever, for both methods
+RRF_K = 60  # rank offset of reciprocal rank fusion; higher gives lower ranks more weight
+MMR_ENABLED = False  # pick diverse chunks from the fused ones with maximal marginal relevance
+MMR_CANDIDATES = 24  # fused chunks MMR picks RETRIEVAL_K from
+MMR_LAMBDA = 0.7  # 1 ranks by relevance only, lower values favour chunks unlike those already picked
+RERANK_ENABLED = False  # re-score fused chunks with a local cross-encoder before building the context
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_CANDIDATES = 24  # fused chunks scored by the reranker
+RERANK_TOP_N = 4  # chunks kept after reranking and sent to the LLM
+RERANK_BATCH_SIZE = 16
+RERANK_TIME_BUDGET_MS = 500  # scoring time per query; past it the fused order is used
+RERANK_CACHE_SIZE = 4096  # (query, chunk id) scores kept
+CONTEXT_TOKENIZER = "unsloth/Meta-Llama-3.1-8B-Instruct"  # tokenizer of GROQ_MODEL, for context budgets (ungated copy; a local path also works)
+
+# INGESTION SETTINGS
+INGEST_BATCH_SIZE = 64  # chunks embedded and indexed per batch
+INGEST_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # PDF extraction processes
+INGEST_PAGES_PER_TASK = 16  # pages extracted per worker task
+INGEST_QUEUE_SIZE = 4  # batches buffered between pipeline stages
+INGEST_JOB_POLL_SECONDS = 1.0  # UI refresh interval while a background job runs
+
+# VECTOR INDEX SETTINGS
+VECTOR_INDEX_TYPE = "auto"  # "flat" (exact), "hnsw", "ivf", "ivfpq", or "auto" to choose by shard size
+# "auto" thresholds count the chunks of one shard, so they must stay below VECTOR_SHARD_SIZE
+VECTOR_INDEX_HNSW_MIN_VECTORS = 50000  # "auto" switches from flat to HNSW at this many chunks
+VECTOR_INDEX_IVF_MIN_VECTORS = 200000  # "auto" switches from HNSW to IVF at this many chunks
+HNSW_M = 32  # graph neighbours per vector
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64  # candidates explored per query; higher is slower and more accurate
+IVF_NLIST = 0  # inverted lists; 0 picks about 4 * sqrt(chunks)
+IVF_NPROBE = 16  # lists scanned per query
+VECTOR_INDEX_IVFPQ_MIN_VECTORS = 500000  # "auto" switches from IVF to IVF-PQ at this many chunks
+PQ_M = 48  # bytes per product-quantized vector
+PQ_OPQ = True  # learn a rotation before product quantization
+PQ_RERANK_FACTOR = 4  # IVF-PQ fetches k * this many candidates and re-ranks them exactly
+VECTOR_STORAGE = "float32"  # "float32" or "float16" (half the memory per vector)
+VECTOR_PCA_DIM = 0  # project vectors to this many dimensions with PCA; 0 keeps them all
+VECTOR_INDEX_MMAP = True  # memory-map IVF indexes read-only when loading a knowledge base
+VECTOR_INDEX_TRAIN_SIZE = 20000  # vectors buffered to train the index of a new knowledge base
+VECTOR_INDEX_RECALL_QUERIES = 100  # sampled queries for the recall@k report of a new index
+VECTOR_SHARD_SIZE = 1000000  # chunks per index shard; "auto" picks each shard's index type by its size
+VECTOR_SEARCH_THREADS = min(8, os.cpu_count() or 1)  # threads searching shards in parallel
 
 # RESPONSE MODE SETTINGS
 RESPONSE_MODES = {
     "Concise": {
         "description": "Short, direct answers",
         "max_tokens": 512,
+        "context_tokens": 1500,  # document context budget of the prompt
         "system_instruction": "Provide a brief, concise answer. Be direct and to the point. Use 2-3 sentences maximum."
     },
     "Detailed": {
         "description": "Comprehensive, in-depth responses",
         "max_tokens": 2048,
+        "context_tokens": 3000,
         "system_instruction": "Provide a comprehensive, detailed answer. Include explanations, examples, and context where relevant."
     }
 }
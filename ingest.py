@@ -0,0 +1,107 @@
+import argparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from config.config import DB_FAISS_PATH, INGEST_WORKERS, EMBEDDING_WORKERS
+from utils.document_processor import (
+    ingest_files, save_knowledge_base, reset_knowledge_base, hash_file
+)
+from utils.ingestion_pipeline import format_throughput_report
+from utils.vector_index import format_index_report
+from models.embeddings import shutdown_encoding_pools
+
+
+def find_pdfs(root):
+    """
+    Find every PDF below a directory.
+
+    Args:
+        root (str): Directory to search recursively
+
+    Returns:
+        list: (file_path, document_name) pairs, where the name is the path
+        relative to root so files with the same base name stay distinct
+    """
+    pdfs = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(".pdf"):
+                file_path = os.path.join(dirpath, filename)
+                pdfs.append((file_path, os.path.relpath(file_path, root)))
+    return sorted(pdfs)
+
+
+def peak_memory_mb():
+    """Return the peak resident memory of this process and its workers in MB."""
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / scale, children / scale
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"Build the knowledge base in {DB_FAISS_PATH} from a directory of PDFs."
+    )
+    parser.add_argument("directory", help="Directory searched recursively for PDF files")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help=f"PDF extraction processes (default: {INGEST_WORKERS})")
+    parser.add_argument("--embed-workers", type=int, default=EMBEDDING_WORKERS,
+                        help=f"Embedding processes, 0 to encode in-process (default: {EMBEDDING_WORKERS})")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Discard the existing knowledge base instead of updating it")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        parser.error(f"Not a directory: {args.directory}")
+
+    pdfs = find_pdfs(args.directory)
+    if not pdfs:
+        print(f"No PDF files found in {args.directory}")
+        return 1
+
+    if args.rebuild:
+        reset_knowledge_base()
+
+    start = time.perf_counter()
+    sources = [(file_path, name, hash_file(file_path)) for file_path, name in pdfs]
+
+    vectorstore, bm25, manifest, results, stats = ingest_files(
+        sources, workers=args.workers, embedding_workers=args.embed_workers
+    )
+    if vectorstore is None:
+        print("No text could be extracted from any document")
+        return 1
+
+    save_knowledge_base(vectorstore, bm25, manifest)
+    elapsed = time.perf_counter() - start
+
+    # Let encoding workers exit so their peak memory is accounted for
+    shutdown_encoding_pools()
+
+    for name, result in sorted(results.items()):
+        print(f"{result['status']:>9}  {name}  ({result['chunks']} chunks, {result['embedded']} embedded)")
+
+    pages = stats["stages"].get("extract", {}).get("items", 0)
+    embedded = sum(result["embedded"] for result in results.values())
+    own_mb, workers_mb = peak_memory_mb()
+
+    print()
+    print(format_throughput_report(stats))
+    if "index" in stats:
+        print(format_index_report(stats["index"]))
+    print()
+    print(f"Documents: {len(results)}  pages: {pages}  chunks embedded: {embedded}  chunks indexed: {bm25.corpus_size}")
+    print(f"Elapsed: {elapsed:.2f}s  pages/sec: {pages / elapsed:.1f}  chunks/sec: {embedded / elapsed:.1f}")
+    print(f"Peak memory: {own_mb:.0f} MB (main process), {workers_mb:.0f} MB (largest worker)")
+    print(f"Written to {DB_FAISS_PATH}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,493 @@
 import sys
 import os
+import importlib.util
+import inspect
+import itertools
+import multiprocessing
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from langchain_core.embeddings import Embeddings
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from config.config import EMBEDDING_MODEL
+from config.config import (
+    EMBEDDING_MODEL, EMBEDDING_BACKEND, ONNX_MODEL_DIR, ONNX_QUANTIZE, EMBEDDING_BATCH_SIZE,
+    EMBEDDING_WORKERS, EMBEDDING_TOKEN_BUDGET
+)
 
+# Process-wide registry: one shared handle per (model name, backend), plus encoding pools
+_registry = {}
+_registry_lock = threading.Lock()
+_preload_thread = None
 
-def get_embedding_model():
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence Transformers model served by ONNX Runtime on CPU.
+
+    The transformer is exported to ONNX once and, when quantize is set,
+    converted to int8 with dynamic quantization. Mean pooling and L2
+    normalization match the PyTorch pipeline, so vectors can be mixed with
+    an index built by the "torch" backend (cosine similarity to the PyTorch
+    vectors is typically above 0.99 for int8; see
+    benchmarks/embedding_backends.py).
     """
-    Get or initialize the embedding model.
-    
+
+    def __init__(self, model_name, model_dir=ONNX_MODEL_DIR, quantize=ONNX_QUANTIZE,
+                 batch_size=EMBEDDING_BATCH_SIZE):
+        try:
+            import onnxruntime
+            from transformers import AutoTokenizer
+            # Needed to export and quantize the model
+            if importlib.util.find_spec("onnx") is None:
+                raise ImportError("onnx")
+        except ImportError:
+            raise ImportError(
+                "The onnx embedding backend needs onnxruntime and onnx. "
+                "Please install them with `pip install onnxruntime onnx`."
+            )
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        export_dir = os.path.join(model_dir, model_name.replace("/", "__"))
+        model_path = export_onnx_model(model_name, export_dir, quantize)
+
+        with open(os.path.join(export_dir, "max_seq_length"), "r") as f:
+            self.max_seq_length = int(f.read())
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        self.model_path = model_path
+
+    def _encode(self, texts):
+        import numpy as np
+
+        # Encode in length order so each batch pads to a similar length
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        sorted_texts = [texts[i] for i in order]
+
+        vectors = []
+        for start in range(0, len(sorted_texts), self.batch_size):
+            encoded = self.tokenizer(
+                sorted_texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            feed = {name: encoded[name].astype(np.int64) for name in self.input_names if name in encoded}
+            token_embeddings = self.session.run(None, feed)[0]
+
+            # Mean pooling over real tokens, then L2 normalization
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.append(pooled)
+
+        if not vectors:
+            return []
+        result = np.empty((len(texts), vectors[0].shape[1]), dtype=np.float32)
+        result[order] = np.concatenate(vectors)
+        return result.tolist()
+
+    def embed_documents(self, texts):
+        return self._encode([text.replace("\n", " ") for text in texts])
+
+    def embed_query(self, text):
+        return self._encode([text.replace("\n", " ")])[0]
+
+    def memory_bytes(self):
+        return os.path.getsize(self.model_path)
+
+
+def _write_onnx_export(model_name, target_dir):
+    """Export the transformer of a Sentence Transformers model and its tokenizer into target_dir."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    sentence_model = SentenceTransformer(model_name, device="cpu")
+    transformer = sentence_model[0].auto_model.eval()
+    tokenizer = sentence_model.tokenizer
+
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+
+    # Newer torch defaults to the dynamo exporter; keep the TorchScript one
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False
+
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            tuple(sample[name] for name in input_names),
+            os.path.join(target_dir, "model.onnx"),
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+            **export_kwargs
+        )
+
+    tokenizer.save_pretrained(target_dir)
+    with open(os.path.join(target_dir, "max_seq_length"), "w") as f:
+        f.write(str(sentence_model.max_seq_length))
+
+
+def export_onnx_model(model_name, export_dir, quantize=ONNX_QUANTIZE):
+    """
+    Export a Sentence Transformers model to ONNX, quantizing it to int8 if asked.
+
+    Existing exports are reused, so this only does work the first time. The
+    export is written to a temporary directory and moved into place once
+    complete, and the quantized model is renamed into place the same way,
+    so an interrupted export is never mistaken for a finished one. A file
+    lock next to export_dir lets one process export while others (such as
+    encoding workers starting together) wait for it.
+
+    Args:
+        model_name (str): Sentence Transformers model name
+        export_dir (str): Directory for the ONNX model and tokenizer files
+        quantize (bool): Also write and return an int8 dynamically quantized model
+
     Returns:
-        HuggingFaceEmbeddings: Initialized embedding model
+        str: Path of the ONNX model to load
     """
+    model_path = os.path.join(export_dir, "model.onnx")
+    quantized_path = os.path.join(export_dir, "model.int8.onnx")
+    if os.path.exists(quantized_path if quantize else model_path):
+        return quantized_path if quantize else model_path
+
+    from filelock import FileLock
+
+    export_dir = os.path.abspath(export_dir)
+    parent_dir = os.path.dirname(export_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+
+    with FileLock(f"{export_dir}.lock"):
+        if not os.path.exists(model_path):
+            temp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=f".{os.path.basename(export_dir)}.")
+            try:
+                _write_onnx_export(model_name, temp_dir)
+                # Leftovers of an export from before exports were atomic
+                shutil.rmtree(export_dir, ignore_errors=True)
+                os.replace(temp_dir, export_dir)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        if not quantize:
+            return model_path
+
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            temp_path = os.path.join(export_dir, "model.int8.partial.onnx")
+            quantize_dynamic(model_path, temp_path, weight_type=QuantType.QInt8)
+            os.replace(temp_path, quantized_path)
+
+    return quantized_path
+
+
+def _load_model(model_name, backend=EMBEDDING_BACKEND):
     try:
-        embeddings = HuggingFaceEmbeddings(
-            model_name=EMBEDDING_MODEL,
+        if backend == "onnx":
+            return OnnxEmbeddings(model_name)
+        if backend != "torch":
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        return HuggingFaceEmbeddings(
+            model_name=model_name,
             model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
+            encode_kwargs={'normalize_embeddings': True, 'batch_size': EMBEDDING_BATCH_SIZE}
         )
-        return embeddings
     except Exception as e:
         raise RuntimeError(f"Failed to load embedding model: {str(e)}")
+
+
+class SharedEmbeddings(Embeddings):
+    """
+    Process-wide handle on an embedding model.
+
+    The model is loaded once, on first use or by preload_embedding_models,
+    and shared by every Streamlit session and thread. Encoding is
+    serialized because the underlying tokenizer is not safe to call from
+    several threads at once; the model already uses all cores per call.
+    """
+
+    def __init__(self, model_name, backend=EMBEDDING_BACKEND):
+        self.model_name = model_name
+        self.backend = backend
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    def load(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    self._model = _load_model(self.model_name, self.backend)
+        return self._model
+
+    def embed_documents(self, texts):
+        model = self.load()
+        with self._encode_lock:
+            return model.embed_documents(texts)
+
+    def embed_query(self, text):
+        model = self.load()
+        with self._encode_lock:
+            return model.embed_query(text)
+
+    def memory_bytes(self):
+        """Bytes held by the model's weights and buffers, 0 if not loaded yet."""
+        if self._model is None:
+            return 0
+        if isinstance(self._model, OnnxEmbeddings):
+            return self._model.memory_bytes()
+        module = self._model.client
+        return sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in itertools.chain(module.parameters(), module.buffers())
+        )
+
+
+# Model used by the current encoding pool worker process
+_worker_model = None
+
+
+def _init_encoding_worker(model_name, backend, threads):
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_model = _load_model(model_name, backend)
+
+
+def _encode_in_worker(texts):
+    return _worker_model.embed_documents(texts)
+
+
+def plan_length_buckets(texts, batch_size=EMBEDDING_BATCH_SIZE, token_budget=EMBEDDING_TOKEN_BUDGET):
+    """
+    Group texts into batches of similar length.
+
+    Texts are sorted by length and cut into batches whose padded size,
+    longest text times batch length, stays within token_budget. Short
+    texts therefore travel in large batches and long ones in small
+    batches, with little padding either way.
+
+    Args:
+        texts (list): Texts to encode
+        batch_size (int): Maximum texts per batch
+        token_budget (int): Maximum padded tokens per batch, estimated at
+            four characters per token
+
+    Returns:
+        list: Batches as lists of indices into texts
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    batches = []
+    batch = []
+    for i in order:
+        tokens = len(texts[i]) // 4 + 2
+        # Sorted ascending, so the newest text is the longest in the batch
+        if batch and (len(batch) >= batch_size or (len(batch) + 1) * tokens > token_budget):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class _PendingEncoding:
+    """Result of EncodingPool.submit_documents, reassembled in input order."""
+
+    def __init__(self, count, batches, futures):
+        self._count = count
+        self._batches = batches
+        self._futures = futures
+
+    def result(self):
+        vectors = [None] * self._count
+        for batch, future in zip(self._batches, self._futures):
+            for i, vector in zip(batch, future.result()):
+                vectors[i] = vector
+        return vectors
+
+
+class EncodingPool(Embeddings):
+    """
+    Multi-process document encoder for large ingestions.
+
+    Each worker process loads its own copy of the model and encodes
+    length-bucketed batches, so encoding scales with cores. Queries are
+    still embedded in-process by the shared model, avoiding a round trip.
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL, backend=EMBEDDING_BACKEND, workers=EMBEDDING_WORKERS,
+                 batch_size=EMBEDDING_BATCH_SIZE, token_budget=EMBEDDING_TOKEN_BUDGET):
+        self.model_name = model_name
+        self.backend = backend
+        self.workers = workers
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        # Spawned, not forked: forking a process that already runs torch threads can deadlock
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_encoding_worker,
+            initargs=(model_name, backend, threads)
+        )
+
+    def submit_documents(self, texts):
+        """
+        Start encoding texts in the pool.
+
+        Returns:
+            object: Handle whose result() returns the vectors in input order
+        """
+        batches = plan_length_buckets(texts, self.batch_size, self.token_budget)
+        futures = [
+            self._executor.submit(_encode_in_worker, [texts[i] for i in batch])
+            for batch in batches
+        ]
+        return _PendingEncoding(len(texts), batches, futures)
+
+    def embed_documents(self, texts):
+        return self.submit_documents(texts).result()
+
+    def embed_query(self, text):
+        return get_embedding_model(self.model_name, self.backend).embed_query(text)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def get_encoding_pool(workers=EMBEDDING_WORKERS, model_name=EMBEDDING_MODEL, backend=EMBEDDING_BACKEND):
+    """
+    Get the process-wide encoding pool, starting it on first use.
+
+    Workers keep their models loaded between ingestions.
+
+    Args:
+        workers (int): Number of encoding processes
+        model_name (str): Sentence Transformers model name
+        backend (str): "torch" or "onnx"
+
+    Returns:
+        EncodingPool: Shared pool for these settings
+    """
+    with _registry_lock:
+        key = ("pool", model_name, backend, workers)
+        if key not in _registry:
+            _registry[key] = EncodingPool(model_name, backend, workers)
+        return _registry[key]
+
+
+def shutdown_encoding_pools():
+    """Stop every encoding pool's worker processes."""
+    with _registry_lock:
+        pools = [key for key, handle in _registry.items() if isinstance(handle, EncodingPool)]
+        pools = [_registry.pop(key) for key in pools]
+    for pool in pools:
+        pool.close()
+
+
+def get_document_encoder(workers=EMBEDDING_WORKERS):
+    """
+    Get the encoder ingestion should use for chunk texts.
+
+    Args:
+        workers (int): Encoding processes; 0 encodes in-process with the
+            shared model
+
+    Returns:
+        Embeddings: EncodingPool when workers > 0, else the shared model
+    """
+    if workers and workers > 0:
+        return get_encoding_pool(workers)
+    return get_embedding_model()
+
+
+def get_embedding_model(model_name=EMBEDDING_MODEL, backend=EMBEDDING_BACKEND):
+    """
+    Get the shared embedding model.
+
+    Returns immediately; the model itself is loaded on first use, once per
+    process.
+
+    Args:
+        model_name (str): Sentence Transformers model name
+        backend (str): "torch" or "onnx"
+
+    Returns:
+        SharedEmbeddings: Process-wide embedding model handle
+    """
+    with _registry_lock:
+        key = (model_name, backend)
+        if key not in _registry:
+            _registry[key] = SharedEmbeddings(model_name, backend)
+        return _registry[key]
+
+
+def preload_embedding_models(model_names=(EMBEDDING_MODEL,), background=False):
+    """
+    Load embedding models ahead of their first use.
+
+    Args:
+        model_names (iterable): Models to load
+        background (bool): Load on a daemon thread and return immediately
+
+    Returns:
+        threading.Thread or None: The loading thread when background is set
+    """
+    global _preload_thread
+    handles = [get_embedding_model(model_name) for model_name in model_names]
+
+    def load_all():
+        for handle in handles:
+            try:
+                handle.load()
+            except Exception as e:
+                print(f"Error preloading embedding model {handle.model_name}: {str(e)}")
+
+    if not background:
+        load_all()
+        return None
+
+    with _registry_lock:
+        if all(handle.is_loaded for handle in handles):
+            return None
+        if _preload_thread is None or not _preload_thread.is_alive():
+            _preload_thread = threading.Thread(target=load_all, name="embedding-preload", daemon=True)
+            _preload_thread.start()
+        return _preload_thread
+
+
+def get_embedding_memory_usage():
+    """
+    Report the memory footprint of every loaded embedding model.
+
+    Returns:
+        dict: "model_name (backend)" to bytes held by its weights (0 if not
+        loaded yet)
+    """
+    with _registry_lock:
+        handles = [handle for handle in _registry.values() if isinstance(handle, SharedEmbeddings)]
+    return {f"{handle.model_name} ({handle.backend})": handle.memory_bytes() for handle in handles}
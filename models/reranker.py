@@ -0,0 +1,135 @@
+import sys
+import os
+import threading
+import time
+from collections import OrderedDict
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config.config import RERANK_MODEL, RERANK_BATCH_SIZE, RERANK_TIME_BUDGET_MS, RERANK_CACHE_SIZE
+
+# Process-wide registry: one shared reranker per model name
+_rerankers = {}
+_rerankers_lock = threading.Lock()
+
+
+def _chunk_key(doc):
+    return doc.metadata.get("chunk_id") or doc.page_content
+
+
+class CrossEncoderReranker:
+    """
+    Process-wide handle on a cross-encoder that re-scores retrieved chunks.
+
+    The model is loaded on first use and runs on CPU, scoring (query,
+    chunk) pairs in batches. Scores are kept in an LRU cache keyed by query
+    and chunk id, so repeated or refined questions only score the chunks
+    not seen yet. Scoring stops once a query has used its time budget; the
+    chunks are then returned in their fused order.
+    """
+
+    def __init__(self, model_name, batch_size=RERANK_BATCH_SIZE, cache_size=RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._model = None
+        # Set once loading was attempted; a failed load is not retried
+        self._loaded = False
+        self._load_error = None
+        self._cache = OrderedDict()
+        self._load_lock = threading.Lock()
+        # Serializes scoring and guards the cache
+        self._score_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    def load(self):
+        if not self._loaded:
+            with self._load_lock:
+                if not self._loaded:
+                    try:
+                        from sentence_transformers import CrossEncoder
+                        self._model = CrossEncoder(self.model_name, device="cpu")
+                    except Exception as e:
+                        self._load_error = f"Failed to load reranker model: {str(e)}"
+                    self._loaded = True
+        if self._model is None:
+            raise RuntimeError(self._load_error)
+        return self._model
+
+    def score(self, query, docs, time_budget_ms=RERANK_TIME_BUDGET_MS):
+        """
+        Score chunks against a query.
+
+        Args:
+            query (str): User question
+            docs (list): Chunks to score
+            time_budget_ms (float): Scoring time allowed for this call; None
+                for no limit. Loading the model and waiting for another
+                call to finish scoring are not counted
+
+        Returns:
+            list: One score per chunk, or None if the budget ran out first
+        """
+        model = self.load()
+        with self._score_lock:
+            start = time.perf_counter()
+            scores = {}
+            for doc in docs:
+                key = (query, _chunk_key(doc))
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[key[1]] = self._cache[key]
+            missing = [doc for doc in docs if _chunk_key(doc) not in scores]
+
+            for batch_start in range(0, len(missing), self.batch_size):
+                if time_budget_ms is not None and (time.perf_counter() - start) * 1000 > time_budget_ms:
+                    return None
+                batch = missing[batch_start:batch_start + self.batch_size]
+                batch_scores = model.predict(
+                    [(query, doc.page_content) for doc in batch],
+                    batch_size=self.batch_size,
+                    show_progress_bar=False
+                )
+                # Batches finished before the budget ran out stay cached
+                for doc, batch_score in zip(batch, batch_scores):
+                    key = (query, _chunk_key(doc))
+                    scores[key[1]] = self._cache[key] = float(batch_score)
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+
+        return [scores[_chunk_key(doc)] for doc in docs]
+
+    def rerank(self, query, docs, top_n, time_budget_ms=RERANK_TIME_BUDGET_MS):
+        """
+        Return the top_n chunks by cross-encoder score.
+
+        Falls back to the first top_n chunks in the given order when the
+        time budget runs out.
+        """
+        scores = self.score(query, docs, time_budget_ms)
+        if scores is None:
+            return docs[:top_n]
+        order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+        return [docs[i] for i in order[:top_n]]
+
+
+def get_reranker(model_name=RERANK_MODEL):
+    """
+    Get the shared cross-encoder reranker.
+
+    Returns immediately; the model itself is loaded on first use, once per
+    process. If loading fails, later calls raise the same error at once
+    instead of trying again.
+
+    Args:
+        model_name (str): Sentence Transformers cross-encoder name
+
+    Returns:
+        CrossEncoderReranker: Process-wide reranker handle
+    """
+    with _rerankers_lock:
+        if model_name not in _rerankers:
+            _rerankers[model_name] = CrossEncoderReranker(model_name)
+        return _rerankers[model_name]
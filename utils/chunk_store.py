@@ -0,0 +1,238 @@
+import sys
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import weakref
+from collections.abc import Sequence
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+CHUNKS_FILE = "chunks.sqlite"
+CHUNK_IDS_FILE = "chunk_ids.npy"
+
+# Ids per query when fetching many chunks at once
+FETCH_BATCH_SIZE = 500
+
+
+def _remove_temp_database(connection, path):
+    connection.close()
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """
+    Chunk texts and metadata in a SQLite file, keyed by chunk id.
+
+    Chunks are read one query at a time, so only the chunks a search
+    returns are ever turned into Documents. A docstore opened on a saved
+    knowledge base reads the file in place; the first change copies it to
+    a private temporary database, so other processes using the saved file
+    never see a half-finished ingestion. save() writes a consistent copy.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._finalizer = None
+        if path is None:
+            self._open_private_copy(None)
+        else:
+            # immutable: the file is never written in place, so SQLite can skip locking
+            self._connection = sqlite3.connect(
+                f"file:{os.path.abspath(path)}?mode=ro&immutable=1", uri=True, check_same_thread=False
+            )
+            self._writable = False
+
+    def _open_private_copy(self, source):
+        fd, temp_path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        connection = sqlite3.connect(temp_path, check_same_thread=False)
+        connection.execute("PRAGMA synchronous = OFF")
+        if source is None:
+            connection.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, text TEXT, metadata TEXT)")
+        else:
+            source.backup(connection)
+            source.close()
+
+        self._connection = connection
+        self._writable = True
+        self._finalizer = weakref.finalize(self, _remove_temp_database, connection, temp_path)
+
+    def _ensure_writable(self):
+        if not self._writable:
+            self._open_private_copy(self._connection)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def search(self, search):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT text, metadata FROM chunks WHERE id = ?", (search,)
+            ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def mget(self, ids):
+        """Return the Documents for several chunk ids, in the given order."""
+        found = {}
+        for start in range(0, len(ids), FETCH_BATCH_SIZE):
+            batch = ids[start:start + FETCH_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})", batch
+                ).fetchall()
+            for chunk_id, text, metadata in rows:
+                found[chunk_id] = Document(page_content=text, metadata=json.loads(metadata))
+
+        missing = [chunk_id for chunk_id in ids if chunk_id not in found]
+        if missing:
+            raise ValueError(f"Could not find documents for ids {missing[:5]}")
+        return [found[chunk_id] for chunk_id in ids]
+
+    def add(self, texts):
+        rows = [(chunk_id, doc.page_content, json.dumps(doc.metadata)) for chunk_id, doc in texts.items()]
+        with self._lock:
+            self._ensure_writable()
+            try:
+                with self._connection:
+                    self._connection.executemany("INSERT INTO chunks VALUES (?, ?, ?)", rows)
+            except sqlite3.IntegrityError:
+                raise ValueError("Tried to add ids that already exist")
+
+    def delete(self, ids):
+        with self._lock:
+            self._ensure_writable()
+            with self._connection:
+                self._connection.executemany("DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in ids])
+
+    def save(self, path):
+        """Write the chunks to a SQLite file at path."""
+        temp_path = f"{path}.tmp"
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        destination = sqlite3.connect(temp_path)
+        try:
+            with self._lock:
+                self._connection.backup(destination)
+        finally:
+            destination.close()
+        os.replace(temp_path, path)
+
+
+class ChunkIdMap:
+    """
+    Index position to chunk id mapping, stored as one fixed-width byte array.
+
+    Stands in for the index_to_docstore_id dict of the FAISS store, using a
+    few dozen bytes per chunk instead of two Python objects, and loads from
+    disk as a memory map.
+    """
+
+    def __init__(self, ids=None):
+        self._blocks = [] if ids is None or not len(ids) else [ids]
+        self._length = 0 if ids is None else len(ids)
+
+    @classmethod
+    def from_ids(cls, ids):
+        return cls(np.array([chunk_id.encode() for chunk_id in ids], dtype=np.bytes_) if ids else None)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path, mmap_mode="r"))
+
+    def _array(self):
+        if len(self._blocks) > 1:
+            self._blocks = [np.concatenate(self._blocks)]
+        return self._blocks[0] if self._blocks else np.array([], dtype=np.bytes_)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, position):
+        if not 0 <= position < self._length:
+            raise KeyError(position)
+        return self._array()[position].decode()
+
+    def get(self, position, default=None):
+        return self[position] if 0 <= position < self._length else default
+
+    def __contains__(self, position):
+        return isinstance(position, (int, np.integer)) and 0 <= position < self._length
+
+    def __iter__(self):
+        return iter(range(self._length))
+
+    def keys(self):
+        return range(self._length)
+
+    def values(self):
+        return [chunk_id.decode() for chunk_id in self._array()]
+
+    def items(self):
+        return list(enumerate(self.values()))
+
+    def update(self, mapping):
+        """Append ids; positions must continue from the current length, as FAISS adds them."""
+        positions = sorted(mapping)
+        if positions != list(range(self._length, self._length + len(positions))):
+            raise ValueError("Chunk ids can only be appended at the end of the index")
+        if positions:
+            self._blocks.append(np.array([mapping[p].encode() for p in positions], dtype=np.bytes_))
+            self._length += len(positions)
+
+    def positions_of(self, chunk_ids):
+        """Return the sorted positions of the given ids, and the ids that are not present."""
+        wanted = np.array([chunk_id.encode() for chunk_id in chunk_ids], dtype=np.bytes_)
+        array = self._array()
+        positions = np.flatnonzero(np.isin(array, wanted))
+        missing = set(chunk_ids) - {chunk_id.decode() for chunk_id in array[positions]}
+        return positions, sorted(missing)
+
+    def keep(self, mask):
+        """Drop the positions where mask is False; later ids move down."""
+        array = self._array()[mask]
+        self._blocks = [array] if len(array) else []
+        self._length = len(array)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.save(f, np.ascontiguousarray(self._array()))
+
+
+class ChunkSequence(Sequence):
+    """The chunks of a store in index order, fetched from its docstore on access."""
+
+    def __init__(self, docstore, index_to_docstore_id):
+        self.docstore = docstore
+        self.index_to_docstore_id = index_to_docstore_id
+
+    def __len__(self):
+        return len(self.index_to_docstore_id)
+
+    def _fetch(self, positions):
+        ids = [self.index_to_docstore_id[position] for position in positions]
+        if hasattr(self.docstore, "mget"):
+            return self.docstore.mget(ids)
+        return [self.docstore.search(chunk_id) for chunk_id in ids]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return self._fetch(range(len(self))[position])
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return self._fetch([position])[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), FETCH_BATCH_SIZE):
+            yield from self._fetch(range(start, min(start + FETCH_BATCH_SIZE, len(self))))
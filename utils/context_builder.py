@@ -0,0 +1,247 @@
+import sys
+import os
+import logging
+import threading
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config.config import CONTEXT_TOKENIZER, CHUNK_OVERLAP, RESPONSE_MODES
+
+CONTEXT_SEPARATOR = "\n\n"
+
+# Shortest text shared by two chunks that counts as their overlap
+MIN_OVERLAP_CHARS = 20
+
+# Characters per token assumed when the tokenizer cannot be loaded
+FALLBACK_CHARS_PER_TOKEN = 4
+
+logger = logging.getLogger(__name__)
+
+_token_counters = {}
+_token_counters_lock = threading.Lock()
+
+
+class TokenCounter:
+    """
+    Counts tokens with the tokenizer of the model the context is sent to.
+
+    The tokenizer is loaded on first use from the local Hugging Face cache
+    (or a local path). If it is not there, it is downloaded on a background
+    thread, so a question never waits on the network; until the download
+    finishes, or if it fails, counts are estimated from the text length.
+    """
+
+    def __init__(self, tokenizer_name):
+        self.tokenizer_name = tokenizer_name
+        self._tokenizer = None
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    @property
+    def is_exact(self):
+        return self._load() is not None
+
+    def _load(self):
+        if not self._loaded:
+            with self._load_lock:
+                if not self._loaded:
+                    try:
+                        from transformers import AutoTokenizer
+                        self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name, local_files_only=True)
+                    except Exception:
+                        logger.warning(
+                            "Tokenizer %s is not cached locally, downloading it in the background; "
+                            "token counts are estimated from text length until then", self.tokenizer_name
+                        )
+                        threading.Thread(target=self._download, daemon=True).start()
+                    self._loaded = True
+        return self._tokenizer
+
+    def _download(self):
+        try:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+        except Exception as e:
+            logger.warning(
+                "Could not load tokenizer %s, token counts are estimated from text length: %s", self.tokenizer_name, e
+            )
+
+    def count(self, texts):
+        """Return the number of tokens of each text."""
+        tokenizer = self._load()
+        if tokenizer is None:
+            return [-(-len(text) // FALLBACK_CHARS_PER_TOKEN) for text in texts]
+        if not texts:
+            return []
+        return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+
+def get_token_counter(tokenizer_name=CONTEXT_TOKENIZER):
+    """Get the shared token counter for a tokenizer, loaded on first use."""
+    with _token_counters_lock:
+        if tokenizer_name not in _token_counters:
+            _token_counters[tokenizer_name] = TokenCounter(tokenizer_name)
+        return _token_counters[tokenizer_name]
+
+
+def preload_token_counter(tokenizer_name=CONTEXT_TOKENIZER, background=False):
+    """
+    Load the context tokenizer ahead of the first question.
+
+    Args:
+        tokenizer_name (str): Tokenizer to load
+        background (bool): Load on a daemon thread and return immediately
+    """
+    counter = get_token_counter(tokenizer_name)
+    if background:
+        threading.Thread(target=counter._load, daemon=True).start()
+    else:
+        counter._load()
+
+
+def get_context_budget(response_mode):
+    """Return the context token budget of a response mode."""
+    if response_mode in RESPONSE_MODES:
+        return RESPONSE_MODES[response_mode]["context_tokens"]
+    return RESPONSE_MODES["Detailed"]["context_tokens"]
+
+
+def overlap_length(first, second, max_overlap=CHUNK_OVERLAP):
+    """Length of the longest end of first that starts second, or 0 if shorter than MIN_OVERLAP_CHARS."""
+    for length in range(min(len(first), len(second), max_overlap), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+def _page_key(doc):
+    return doc.metadata.get("document_id", doc.metadata.get("source")), doc.metadata.get("page")
+
+
+class _Passage:
+    """Chunks of one page stitched together, in text order."""
+
+    def __init__(self, doc):
+        self.key = _page_key(doc)
+        self.text = doc.page_content
+
+    def stitched(self, key, text):
+        """Return this passage with text joined at either end, or None if they do not overlap."""
+        if key != self.key:
+            return None
+        if text in self.text:
+            return self.text
+        length = overlap_length(self.text, text)
+        if length:
+            return self.text + text[length:]
+        length = overlap_length(text, self.text)
+        if length:
+            return text + self.text[length:]
+        return None
+
+
+def _join_bridged(passages, passage_tokens, i, total, separator_tokens, token_counter):
+    """Join passage i with another passage of its page that it now overlaps; returns the new total."""
+    for j in range(len(passages)):
+        if j == i:
+            continue
+        text = passages[i].stitched(passages[j].key, passages[j].text)
+        if text is None:
+            continue
+        tokens = token_counter.count([text])[0]
+        total += tokens - passage_tokens[i] - passage_tokens[j] - separator_tokens
+        passages[i].text = text
+        passage_tokens[i] = tokens
+        del passages[j], passage_tokens[j]
+        break
+    return total
+
+
+def pack_context(docs, budget, token_counter=None):
+    """
+    Build the prompt context from retrieved chunks within a token budget.
+
+    Chunks are taken in the given (relevance) order. A chunk that continues
+    or precedes a chunk already taken from the same page is stitched to it,
+    dropping the text the two share (up to CHUNK_OVERLAP characters), so
+    overlaps are sent once. A chunk that would exceed the budget is skipped
+    and smaller ones after it are still tried.
+
+    Args:
+        docs (list): Retrieved chunks, best first
+        budget (int): Maximum tokens of the context
+        token_counter (TokenCounter): Defaults to the CONTEXT_TOKENIZER one
+
+    Returns:
+        tuple: (context, used_docs, report) where used_docs are the chunks
+        included, best first, and report holds "tokens" (context size),
+        "naive_tokens" (all chunks joined as they are), "overlap_tokens"
+        (saved by stitching overlaps), "dropped_tokens" (of the chunks left
+        out for the budget), "chunks", "merged" and "dropped" counts and
+        "exact" (False if the counts are estimates)
+    """
+    token_counter = token_counter or get_token_counter()
+    separator_tokens = token_counter.count([CONTEXT_SEPARATOR])[0]
+    doc_tokens = token_counter.count([doc.page_content for doc in docs])
+    naive_tokens = sum(doc_tokens) + separator_tokens * max(len(docs) - 1, 0)
+
+    passages = []
+    passage_tokens = []
+    used_docs = []
+    dropped = 0
+    dropped_tokens = 0
+    overlap_tokens = 0
+    total = 0
+    for doc, tokens in zip(docs, doc_tokens):
+        for i, passage in enumerate(passages):
+            text = passage.stitched(_page_key(doc), doc.page_content)
+            if text is None:
+                continue
+            new_tokens = token_counter.count([text])[0]
+            if total - passage_tokens[i] + new_tokens <= budget:
+                passage.text = text
+                # Joined as they are, the chunk would have added its tokens and a separator
+                overlap_tokens += tokens + separator_tokens - (new_tokens - passage_tokens[i])
+                total += new_tokens - passage_tokens[i]
+                passage_tokens[i] = new_tokens
+                used_docs.append(doc)
+                joined = _join_bridged(passages, passage_tokens, i, total, separator_tokens, token_counter)
+                overlap_tokens += total - joined
+                total = joined
+            else:
+                dropped += 1
+                dropped_tokens += tokens
+            break
+        else:
+            added = tokens + (separator_tokens if passages else 0)
+            if total + added <= budget:
+                passages.append(_Passage(doc))
+                passage_tokens.append(tokens)
+                used_docs.append(doc)
+                total += added
+            else:
+                dropped += 1
+                dropped_tokens += tokens
+
+    context = CONTEXT_SEPARATOR.join(passage.text for passage in passages)
+    report = {
+        "tokens": total,
+        "naive_tokens": naive_tokens,
+        "overlap_tokens": overlap_tokens,
+        "dropped_tokens": dropped_tokens,
+        "chunks": len(used_docs),
+        # Chunks stitched onto another one
+        "merged": len(used_docs) - len(passages),
+        "dropped": dropped,
+        "exact": token_counter.is_exact
+    }
+    return context, used_docs, report
+
+
+def format_context_report(report):
+    """Format a pack_context report as one line."""
+    estimated = "" if report["exact"] else " (estimated)"
+    return (
+        f"Context: {report['tokens']} tokens{estimated} from {report['chunks']} chunks "
+        f"({report['merged']} stitched, saving {report['overlap_tokens']} overlap tokens; "
+        f"{report['dropped']} chunks of {report['dropped_tokens']} tokens over budget)"
+    )
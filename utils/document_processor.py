@@ -1,64 +1,511 @@
 import sys
 import os
+import hashlib
+import shutil
 import tempfile
+import time
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from langchain_community.document_loaders import PyPDFLoader
+import numpy as np
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from rank_bm25 import BM25Okapi
-from config.config import CHUNK_SIZE, CHUNK_OVERLAP, DB_FAISS_PATH
-from models.embeddings import get_embedding_model
+from config.config import (
+    CHUNK_SIZE, CHUNK_OVERLAP, DB_FAISS_PATH, BM25_PATH, MANIFEST_PATH, INGEST_WORKERS,
+    EMBEDDING_WORKERS
+)
+from models.embeddings import get_embedding_model, get_document_encoder
+from utils.ingestion_pipeline import (
+    run_ingestion_pipeline, new_stage_stats, record_stage
+)
+from utils.sharded_index import ShardedFAISS, ShardedWriter
+from utils.lexical_index import BM25Index
+from utils.manifest import (
+    load_manifest, save_manifest, new_manifest, new_document_entry,
+    hash_text, make_document_id, make_chunk_id
+)
 
+UPLOAD_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Single-index stores saved before documents were tracked keep their
+# chunks in this pickle and have no manifest
+LEGACY_STORE_PATH = os.path.join(DB_FAISS_PATH, "index.pkl")
+LEGACY_DOCUMENT_NAME = "Earlier knowledge base"
+
+# (manifest mtime and size, list_documents result) of the last listing
+_document_listing = (None, [])
+
+
+def copy_upload_to_temp(file):
+    """
+    Stream an upload to a temporary PDF in fixed-size blocks, hashing it on the way.
+
+    Args:
+        file: Uploaded file object with read()
+
+    Returns:
+        tuple: (temp_file_path, sha256 hex digest); the caller removes the file
+    """
+    sha256 = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+        while True:
+            block = file.read(UPLOAD_COPY_BUFFER_SIZE)
+            if not block:
+                break
+            sha256.update(block)
+            temp_file.write(block)
+    return temp_file.name, sha256.hexdigest()
+
+
+def hash_file(file_path):
+    """Hash a file on disk in fixed-size blocks."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_COPY_BUFFER_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_store_documents(vectorstore):
+    """
+    Return the chunks held by a FAISS store, in shard and index order.
+
+    The sequence reads chunks from the docstores as they are accessed, so
+    only the chunks actually used are loaded into memory.
+    """
+    return vectorstore.documents()
+
+
+def build_bm25(docs):
+    return BM25Index.from_texts(doc.page_content for doc in docs)
+
+
+def _adopt_legacy_store(vectorstore):
+    """
+    Build a manifest for a knowledge base saved before documents were tracked.
+
+    All of its chunks are recorded as one document, LEGACY_DOCUMENT_NAME,
+    so they can be listed and deleted and new uploads are added next to
+    them. The store is converted to the current format on its next save.
+    """
+    entry = new_document_entry(LEGACY_DOCUMENT_NAME, "")
+    entry["ingested_at"] = 0
+    chunk_ids = (chunk_id for shard in vectorstore.shards for chunk_id in shard.index_to_docstore_id.values())
+    for chunk_id, doc in zip(chunk_ids, get_store_documents(vectorstore)):
+        page_key = str(doc.metadata.get("page", 0))
+        entry["pages"][page_key] = ""
+        entry["chunks"][chunk_id] = page_key
+
+    manifest = new_manifest()
+    manifest["documents"][make_document_id(LEGACY_DOCUMENT_NAME)] = entry
+    return manifest
+
+
+def _open_collection(vectorstore=None, bm25=None):
+    """
+    Return the manifest and the vector store and BM25 index it describes.
+
+    The manifest decides what the knowledge base holds: without any
+    documents in it, any store left on disk is ignored and a fresh one is
+    built, unless it is a store from before the manifest existed (see
+    _adopt_legacy_store).
+    """
+    manifest = load_manifest()
+    if not manifest["documents"] and not os.path.exists(LEGACY_STORE_PATH):
+        return new_manifest(), None, None
+
+    if vectorstore is None:
+        vectorstore, bm25, _ = load_knowledge_base()
+        if vectorstore is None:
+            return new_manifest(), None, None
+    elif bm25 is None:
+        bm25 = build_bm25(get_store_documents(vectorstore))
+
+    if not manifest["documents"]:
+        manifest = _adopt_legacy_store(vectorstore)
+    return manifest, vectorstore, bm25
+
+
+def ingest_files(sources, vectorstore=None, bm25=None, workers=INGEST_WORKERS, progress=None, cancel_event=None,
+                 embedding_workers=EMBEDDING_WORKERS):
+    """
+    Add or update PDFs in the knowledge base in a single pipeline run.
+
+    Existing vectors are never rebuilt: only chunks that are new or changed
+    are embedded, and chunks that disappeared from a re-ingested document
+    are deleted. The BM25 index is updated with the same chunks in place.
+    Nothing is written to disk; see save_knowledge_base.
+
+    Args:
+        sources (list): (file_path, document_name, file_hash) tuples
+        vectorstore (ShardedFAISS): Current store to update, loaded from disk if None
+        bm25 (BM25Index): Keyword index of vectorstore, loaded or built if None
+        workers (int): Number of PDF extraction processes
+        progress (callable): Optional progress hook, see run_ingestion_pipeline
+        cancel_event (threading.Event): Optional; set it to stop the ingestion,
+            which then raises IngestionCancelled
+        embedding_workers (int): Encoding processes; 0 encodes in-process
+
+    Returns:
+        tuple: (vectorstore, bm25, manifest, results, stats) where results maps each
+        document name to its status ("added", "updated", "unchanged" or
+        "empty") and chunk counts, and stats is the pipeline throughput report,
+        plus an "index" entry (see measure_index) when a new index other than
+        an exact flat one was built
+    """
+    embeddings = get_embedding_model()
+    encoder = get_document_encoder(embedding_workers)
+    manifest, vectorstore, bm25 = _open_collection(vectorstore, bm25)
+    if bm25 is None:
+        bm25 = BM25Index.from_texts([])
+    results = {}
+    jobs = {}
+
+    for file_path, document_name, file_hash in sources:
+        if document_name in results:
+            raise ValueError(f"Duplicate document name: {document_name}")
+
+        document_id = make_document_id(document_name)
+        previous = manifest["documents"].get(document_id)
+
+        # Byte-identical re-ingestion: nothing to extract or embed
+        if previous and previous["sha256"] == file_hash:
+            results[document_name] = {
+                "status": "unchanged", "embedded": 0, "removed": 0, "chunks": len(previous["chunks"])
+            }
+            continue
+
+        old_chunks = previous["chunks"] if previous else {}
+        old_chunks_by_page = {}
+        for chunk_id, chunk_page in old_chunks.items():
+            old_chunks_by_page.setdefault(chunk_page, []).append(chunk_id)
+
+        jobs[file_path] = {
+            "name": document_name,
+            "document_id": document_id,
+            "old_pages": previous["pages"] if previous else {},
+            "old_chunks": old_chunks,
+            "old_chunks_by_page": old_chunks_by_page,
+            "entry": new_document_entry(document_name, file_hash),
+            "embedded": 0
+        }
+        results[document_name] = {"status": "updated" if previous else "added"}
+
+    if not jobs:
+        return vectorstore, bm25, manifest, results, new_stage_stats()
+
+    jobs_by_name = {job["name"]: job for job in jobs.values()}
+    writer = ShardedWriter(vectorstore, embeddings)
+    # New chunks are appended after these, in the store and in the BM25 index
+    bm25_size = bm25.corpus_size
+    bm25_time = 0.0
+
+    def page_filter(page):
+        job = jobs[page.metadata["source"]]
+        page.metadata["source"] = job["name"]
+        page.metadata["document_id"] = job["document_id"]
+        page_key = str(page.metadata["page"])
+        page_hash = hash_text(page.page_content)
+        job["entry"]["pages"][page_key] = page_hash
+
+        if job["old_pages"].get(page_key) == page_hash:
+            # Unchanged page: keep its chunks without splitting again
+            for chunk_id in job["old_chunks_by_page"].get(page_key, []):
+                job["entry"]["chunks"][chunk_id] = page_key
+            return False
+        return True
+
+    def chunk_filter(chunk):
+        job = jobs_by_name[chunk.metadata["source"]]
+        page_key = str(chunk.metadata["page"])
+        chunk_id = make_chunk_id(job["document_id"], page_key, chunk.page_content)
+        if chunk_id in job["entry"]["chunks"]:
+            # Duplicate chunk within the page
+            return False
+
+        chunk.metadata["chunk_id"] = chunk_id
+        job["entry"]["chunks"][chunk_id] = page_key
+        return chunk_id not in job["old_chunks"]
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP
+    )
+
+    # Embed and index chunks batch by batch as the pipeline delivers
+    # them, so only a few batches of pages and vectors are alive at once
+    def index_batch(batch, vectors):
+        nonlocal bm25_time
+        texts = [doc.page_content for doc in batch]
+        writer.add(texts, vectors, [doc.metadata for doc in batch], [doc.metadata["chunk_id"] for doc in batch])
+        start = time.perf_counter()
+        bm25.add(texts)
+        bm25_time += time.perf_counter() - start
+        for doc in batch:
+            jobs_by_name[doc.metadata["source"]]["embedded"] += 1
 
-def process_document(file):
     try:
-        embeddings = get_embedding_model()
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            temp_file.write(file.read())
-            temp_file_path = temp_file.name
-        
+        stats = run_ingestion_pipeline(
+            list(jobs), text_splitter, encoder, index_batch, workers=workers,
+            page_filter=page_filter, chunk_filter=chunk_filter,
+            progress=progress, cancel_event=cancel_event
+        )
+        vectorstore = writer.finish()
+    except Exception:
+        # Leave the caller's store and index as they were before these documents
+        writer.rollback()
+        bm25.remove(np.arange(bm25_size, bm25.corpus_size))
+        raise
+
+    if writer.report:
+        stats["index"] = writer.report
+
+    stale_ids = []
+    for job in jobs.values():
+        entry = job["entry"]
+        removed = [chunk_id for chunk_id in job["old_chunks"] if chunk_id not in entry["chunks"]]
+        stale_ids.extend(removed)
+
+        result = results[job["name"]]
+        result.update({"embedded": job["embedded"], "removed": len(removed), "chunks": len(entry["chunks"])})
+
+        if entry["chunks"]:
+            manifest["documents"][job["document_id"]] = entry
+        else:
+            manifest["documents"].pop(job["document_id"], None)
+            result["status"] = "empty"
+
+    # Drop chunks that no longer exist in the new versions
+    if stale_ids:
+        # Positions are resolved before the store compacts them; BM25 is
+        # only updated once the store has accepted the delete
+        positions = vectorstore.select_chunks(stale_ids).corpus_positions
+        vectorstore.delete(stale_ids)
+        start = time.perf_counter()
+        bm25.remove(positions)
+        bm25_time += time.perf_counter() - start
+    embedded = sum(job["embedded"] for job in jobs.values())
+    record_stage(stats, "bm25", embedded + len(stale_ids), bm25_time, "chunks")
+
+    # Switch index type of shards that crossed an "auto" size threshold
+    index_report = vectorstore.fit_index_to_corpus()
+    if index_report:
+        stats["index"] = index_report
+
+    return vectorstore, bm25, manifest, results, stats
+
+
+def save_knowledge_base(vectorstore, bm25, manifest):
+    """
+    Persist the vector store, BM25 index and manifest.
+
+    The store is written to a staging directory and swapped in with renames,
+    so readers never see a half-written index. The manifest is written last
+    so it never describes chunks that are not on disk yet.
+    """
+    staging_path = f"{DB_FAISS_PATH}.staging"
+    previous_path = f"{DB_FAISS_PATH}.previous"
+    shutil.rmtree(staging_path, ignore_errors=True)
+    shutil.rmtree(previous_path, ignore_errors=True)
+
+    vectorstore.save_local(staging_path)
+    bm25.save(os.path.join(staging_path, os.path.basename(BM25_PATH)))
+
+    if os.path.exists(DB_FAISS_PATH):
+        os.replace(DB_FAISS_PATH, previous_path)
+    os.replace(staging_path, DB_FAISS_PATH)
+    shutil.rmtree(previous_path, ignore_errors=True)
+
+    save_manifest(manifest)
+
+
+def describe_result(document_name, result):
+    """Summarise the outcome of ingesting one document for display."""
+    status = result["status"]
+    if status == "unchanged":
+        return f"✅ {document_name} is unchanged, reused {result['chunks']} indexed chunks"
+    if status == "updated":
+        return (
+            f"✅ Updated {document_name}: re-embedded {result['embedded']} changed chunks, "
+            f"removed {result['removed']}, kept {result['chunks'] - result['embedded']}"
+        )
+    if status == "empty":
+        return f"⚠️ No text could be extracted from {document_name}"
+    return f"✅ Added {document_name} ({result['chunks']} chunks)"
+
+
+def process_document(file, vectorstore=None, bm25=None):
+    """
+    Add an uploaded PDF to the knowledge base, or update it if already present.
+
+    Args:
+        file: Uploaded file object with read() and name
+        vectorstore (ShardedFAISS): Current store to update, loaded from disk if None
+        bm25 (BM25Index): Keyword index of vectorstore, updated in place
+
+    Returns:
+        tuple: (vectorstore, bm25, docs, message, stats) for the whole
+        knowledge base, where stats is the ingestion report of ingest_files
+        (see format_throughput_report and format_index_report)
+    """
+    try:
+        document_name = getattr(file, "name", "document.pdf")
+
+        # Stream the upload to disk instead of reading it into memory at once
+        temp_file_path, file_hash = copy_upload_to_temp(file)
+
         try:
-            # Load PDF
-            loader = PyPDFLoader(temp_file_path)
-            pages = loader.load()
-            
-            # Split into chunks
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=CHUNK_SIZE,
-                chunk_overlap=CHUNK_OVERLAP
+            vectorstore, bm25, manifest, results, stats = ingest_files(
+                [(temp_file_path, document_name, file_hash)], vectorstore, bm25
             )
-            docs = text_splitter.split_documents(pages)
-            
-            # Create BM25 index
-            corpus_texts = [doc.page_content for doc in docs]
-            bm25 = BM25Okapi([text.split() for text in corpus_texts])
-            
-            # Create FAISS vectorstore
-            vectorstore = FAISS.from_documents(docs, embeddings)
-            
-            # Save to disk
-            os.makedirs(os.path.dirname(DB_FAISS_PATH), exist_ok=True)
-            vectorstore.save_local(DB_FAISS_PATH)
-            
-            message = f"✅ Processed {len(pages)} pages into {len(docs)} chunks"
-            
-            return vectorstore, bm25, docs, message
-        
+            result = results[document_name]
+
+            if result["status"] == "empty" or vectorstore is None:
+                raise ValueError("No text could be extracted from the document")
+
+            docs = get_store_documents(vectorstore)
+
+            if result["status"] == "unchanged":
+                return vectorstore, bm25, docs, describe_result(document_name, result), stats
+
+            save_knowledge_base(vectorstore, bm25, manifest)
+
+            if result["status"] == "updated":
+                message = describe_result(document_name, result)
+            else:
+                page_count = stats["stages"].get("extract", {}).get("items", 0)
+                message = f"✅ Processed {page_count} pages into {result['chunks']} chunks"
+
+            return vectorstore, bm25, docs, message, stats
+
         finally:
             if os.path.exists(temp_file_path):
                 os.unlink(temp_file_path)
-    
+
     except Exception as e:
         raise Exception(f"Error processing document: {str(e)}")
 
 
+def delete_document(document_id, vectorstore=None, bm25=None):
+    """
+    Remove a document and all of its chunks from the knowledge base.
+
+    Args:
+        document_id (str): Id of the document, as returned by list_documents
+        vectorstore (ShardedFAISS): Current store to update, loaded from disk if None
+        bm25 (BM25Index): Keyword index of vectorstore, updated in place
+
+    Returns:
+        tuple: (vectorstore, bm25, docs, message) for the remaining knowledge
+        base; vectorstore and bm25 are None once it is empty
+    """
+    try:
+        manifest, vectorstore, bm25 = _open_collection(vectorstore, bm25)
+        entry = manifest["documents"].pop(document_id, None)
+        if entry is None:
+            raise ValueError(f"Unknown document id: {document_id}")
+
+        message = f"✅ Removed {entry['name']} ({len(entry['chunks'])} chunks)"
+
+        if not manifest["documents"]:
+            reset_knowledge_base()
+            return None, None, [], message
+
+        chunk_ids = list(entry["chunks"])
+        # Positions are resolved before the store compacts them; BM25 is
+        # only updated once the store has accepted the delete
+        positions = vectorstore.select_chunks(chunk_ids).corpus_positions
+        vectorstore.delete(chunk_ids)
+        bm25.remove(positions)
+        docs = get_store_documents(vectorstore)
+
+        save_knowledge_base(vectorstore, bm25, manifest)
+
+        return vectorstore, bm25, docs, message
+
+    except Exception as e:
+        raise Exception(f"Error deleting document: {str(e)}")
+
+
+def _manifest_stamp():
+    try:
+        stat = os.stat(MANIFEST_PATH)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def list_documents():
+    """
+    List the documents in the knowledge base.
+
+    The manifest holds the id of every chunk, so the listing is cached and
+    the manifest is only parsed again after it was rewritten.
+
+    Returns:
+        list: Dicts with "document_id", "name", "pages" and "chunks"
+    """
+    global _document_listing
+    stamp = _manifest_stamp()
+    cached_stamp, documents = _document_listing
+    if stamp is not None and stamp == cached_stamp:
+        return list(documents)
+
+    manifest = load_manifest()
+    documents = [
+        {
+            "document_id": document_id,
+            "name": entry["name"],
+            "pages": len(entry["pages"]),
+            "chunks": len(entry["chunks"])
+        }
+        for document_id, entry in manifest["documents"].items()
+    ]
+    _document_listing = (stamp, documents)
+    return list(documents)
+
+
+def reset_knowledge_base():
+    """Delete the persisted vector store and manifest."""
+    shutil.rmtree(DB_FAISS_PATH, ignore_errors=True)
+    if os.path.exists(MANIFEST_PATH):
+        os.unlink(MANIFEST_PATH)
+
+
+def load_knowledge_base():
+    """
+    Load the vector store, BM25 index and chunks saved by save_knowledge_base.
+
+    The chunks are read from the vector store's chunk store. A BM25 index
+    that is missing or from another format version is rebuilt from them
+    instead of from the PDFs. A store from before the manifest existed gets
+    one written for it, so its chunks show up in list_documents.
+
+    Returns:
+        tuple: (vectorstore, bm25, docs), or (None, None, []) if there is no
+        knowledge base
+    """
+    vectorstore = load_existing_vectorstore()
+    if vectorstore is None:
+        return None, None, []
+
+    docs = get_store_documents(vectorstore)
+    try:
+        bm25 = BM25Index.load(BM25_PATH, expected_chunks=len(docs))
+    except Exception as e:
+        print(f"Error loading BM25 index: {str(e)}")
+        bm25 = None
+    if bm25 is None:
+        bm25 = build_bm25(docs)
+
+    if os.path.exists(LEGACY_STORE_PATH) and not load_manifest()["documents"]:
+        save_manifest(_adopt_legacy_store(vectorstore))
+    return vectorstore, bm25, docs
+
+
 def load_existing_vectorstore():
     try:
         if os.path.exists(DB_FAISS_PATH):
             embeddings = get_embedding_model()
-            vectorstore = FAISS.load_local(
+            vectorstore = ShardedFAISS.load_local(
                 DB_FAISS_PATH,
                 embeddings,
                 allow_dangerous_deserialization=True
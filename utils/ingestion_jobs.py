@@ -0,0 +1,222 @@
+import sys
+import os
+import threading
+import time
+import uuid
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pypdf import PdfReader
+from utils.document_processor import (
+    copy_upload_to_temp, ingest_files, delete_document, get_store_documents,
+    save_knowledge_base, describe_result
+)
+from utils.manifest import make_document_id
+from utils.ingestion_pipeline import IngestionCancelled
+from utils.question_generator import generate_insightful_questions
+
+# One worker: ingestions and deletes run one after another, so two jobs
+# never update the persisted knowledge base at the same time
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingestion-job")
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+def submit_ingestion_job(uploaded_files, num_questions=3):
+    """
+    Queue uploaded PDFs for ingestion on a background thread.
+
+    The uploads are copied to temporary files before returning, so the job
+    does not depend on the Streamlit session that submitted it. The job
+    works on its own copy of the knowledge base; the caller keeps using its
+    current index until it swaps in the job's result.
+
+    Args:
+        uploaded_files (list): Uploaded file objects with read() and name
+        num_questions (int): Suggested questions to generate afterwards
+
+    Returns:
+        str: Job id for get_job and cancel_job
+    """
+    sources = []
+    for uploaded_file in uploaded_files:
+        temp_file_path, file_hash = copy_upload_to_temp(uploaded_file)
+        sources.append((temp_file_path, uploaded_file.name, file_hash))
+
+    job = _new_job("ingest", [name for _, name, _ in sources])
+    _executor.submit(_run_job, job, sources, num_questions)
+    return job["job_id"]
+
+
+def submit_delete_job(document_id, document_name):
+    """
+    Queue the removal of a document behind any queued or running ingestion.
+
+    Deleting through the job queue keeps a single writer: a running job
+    would otherwise save its copy of the knowledge base over the delete and
+    bring the document back. The result has the same form as an ingestion
+    job's.
+
+    Args:
+        document_id (str): Id of the document, as returned by list_documents
+        document_name (str): Name shown while the job is queued
+
+    Returns:
+        str: Job id for get_job
+    """
+    job = _new_job("delete", [document_name])
+    _executor.submit(_run_delete_job, job, document_id)
+    return job["job_id"]
+
+
+def _new_job(kind, documents):
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        "job_id": job_id,
+        "kind": kind,
+        "status": "queued",
+        "stage": "Queued",
+        "documents": documents,
+        "total_pages": 0,
+        "pages_extracted": 0,
+        "chunks_embedded": 0,
+        "messages": [],
+        "error": None,
+        "result": None,
+        "submitted_at": time.time(),
+        "cancel_event": threading.Event()
+    }
+
+    with _jobs_lock:
+        _jobs[job_id] = job
+    return job
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def cancel_job(job_id):
+    """Ask a queued or running job to stop. Returns False if it already finished."""
+    job = get_job(job_id)
+    if job is None or job["status"] not in ACTIVE_STATUSES:
+        return False
+    job["cancel_event"].set()
+    return True
+
+
+def forget_job(job_id):
+    """Drop a finished job, and its result, from the registry."""
+    with _jobs_lock:
+        _jobs.pop(job_id, None)
+
+
+def _count_pages(sources):
+    total = 0
+    for file_path, _, _ in sources:
+        try:
+            total += len(PdfReader(file_path).pages)
+        except Exception:
+            pass
+    return total
+
+
+def _run_job(job, sources, num_questions):
+    try:
+        if job["cancel_event"].is_set():
+            raise IngestionCancelled("Ingestion was cancelled")
+
+        job["status"] = "running"
+        job["stage"] = "Extracting and embedding"
+        job["total_pages"] = _count_pages(sources)
+
+        def progress(stage, items):
+            if stage == "extract":
+                job["pages_extracted"] += items
+            elif stage == "index":
+                job["chunks_embedded"] += items
+
+        vectorstore, bm25, manifest, results, _ = ingest_files(
+            sources, progress=progress, cancel_event=job["cancel_event"]
+        )
+        if vectorstore is None:
+            raise ValueError("No text could be extracted from the documents")
+
+        docs = get_store_documents(vectorstore)
+
+        if job["cancel_event"].is_set():
+            raise IngestionCancelled("Ingestion was cancelled")
+
+        job["messages"] = [describe_result(name, result) for name, result in results.items()]
+
+        # Byte-identical re-uploads change nothing: no save and no new questions
+        new_names = [name for name, result in results.items() if result["status"] not in ("empty", "unchanged")]
+        if any(result["status"] != "unchanged" for result in results.values()):
+            job["stage"] = "Saving knowledge base"
+            save_knowledge_base(vectorstore, bm25, manifest)
+
+        # Suggested questions come from the first chunks of the last document
+        # with new chunks, looked up by id instead of scanning the chunk store
+        questions = []
+        if new_names and num_questions:
+            job["stage"] = "Generating suggested questions"
+            entry = manifest["documents"][make_document_id(new_names[-1])]
+            selection = vectorstore.select_chunks(list(islice(entry["chunks"], 20)))
+            doc_content = "\n\n".join([docs[int(position)].page_content for position in selection.corpus_positions])
+            questions = generate_insightful_questions(doc_content, num_questions)
+
+        job["result"] = {
+            "vectorstore": vectorstore,
+            "bm25": bm25,
+            "docs": docs,
+            "suggested_questions": questions
+        }
+        job["stage"] = "Done"
+        job["status"] = "done"
+
+    except IngestionCancelled:
+        job["stage"] = "Cancelled"
+        job["status"] = "cancelled"
+
+    except Exception as e:
+        job["stage"] = "Failed"
+        job["error"] = f"Error processing documents: {str(e)}"
+        job["status"] = "failed"
+
+    finally:
+        for file_path, _, _ in sources:
+            if os.path.exists(file_path):
+                os.unlink(file_path)
+
+
+def _run_delete_job(job, document_id):
+    try:
+        if job["cancel_event"].is_set():
+            raise IngestionCancelled("Deletion was cancelled")
+
+        job["status"] = "running"
+        job["stage"] = f"Removing {job['documents'][0]}"
+        vectorstore, bm25, docs, message = delete_document(document_id)
+
+        job["messages"] = [message]
+        job["result"] = {
+            "vectorstore": vectorstore,
+            "bm25": bm25,
+            "docs": docs,
+            "suggested_questions": []
+        }
+        job["stage"] = "Done"
+        job["status"] = "done"
+
+    except IngestionCancelled:
+        job["stage"] = "Cancelled"
+        job["status"] = "cancelled"
+
+    except Exception as e:
+        job["stage"] = "Failed"
+        job["error"] = str(e)
+        job["status"] = "failed"
@@ -0,0 +1,354 @@
+import sys
+import os
+import collections
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pypdf import PdfReader
+from langchain.docstore.document import Document
+from config.config import (
+    INGEST_BATCH_SIZE, INGEST_WORKERS, INGEST_PAGES_PER_TASK, INGEST_QUEUE_SIZE
+)
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class IngestionCancelled(Exception):
+    """Raised when an ingestion is stopped through its cancel event."""
+
+
+def iter_pdf_pages(file_path):
+    """
+    Lazily yield the pages of a PDF one at a time.
+
+    Produces the same Documents as PyPDFLoader, but never holds more than
+    the current page's text in memory.
+
+    Args:
+        file_path (str): Path to the PDF on disk
+
+    Yields:
+        Document: One document per page with "source" and "page" metadata
+    """
+    reader = PdfReader(file_path)
+    for page_number, page in enumerate(reader.pages):
+        yield Document(
+            page_content=page.extract_text(),
+            metadata={"source": file_path, "page": page_number}
+        )
+
+
+def _extract_page_range(file_path, start, end):
+    """Extract the text of pages [start, end) in a worker process."""
+    reader = PdfReader(file_path)
+    return [(page_number, reader.pages[page_number].extract_text()) for page_number in range(start, end)]
+
+
+def _iter_page_ranges(file_paths, pages_per_task):
+    """Yield (file_path, start, end) extraction tasks, opening files only as they are reached."""
+    for file_path in file_paths:
+        page_count = len(PdfReader(file_path).pages)
+        for start in range(0, page_count, pages_per_task):
+            yield file_path, start, min(start + pages_per_task, page_count)
+
+
+def iter_pdf_pages_parallel(file_paths, workers=INGEST_WORKERS, pages_per_task=INGEST_PAGES_PER_TASK):
+    """
+    Extract PDF pages in a process pool, yielding them in file and page order.
+
+    Tasks from consecutive files share the pool, so a directory of small
+    PDFs keeps every worker busy. At most two tasks per worker are in
+    flight, so memory stays bounded no matter how much is ingested.
+
+    Args:
+        file_paths (str or list): Path or paths of PDFs on disk
+        workers (int): Number of extraction processes
+        pages_per_task (int): Pages extracted per task
+
+    Yields:
+        Document: One document per page with "source" and "page" metadata
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+
+    if workers <= 1:
+        for file_path in file_paths:
+            yield from iter_pdf_pages(file_path)
+        return
+
+    ranges = _iter_page_ranges(file_paths, pages_per_task)
+
+    # Spawned, not forked: the embedding model may already be running torch threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = []
+        while True:
+            for file_path, start, end in ranges:
+                pending.append((file_path, executor.submit(_extract_page_range, file_path, start, end)))
+                if len(pending) >= workers * 2:
+                    break
+
+            if not pending:
+                break
+
+            file_path, future = pending.pop(0)
+            for page_number, text in future.result():
+                yield Document(
+                    page_content=text,
+                    metadata={"source": file_path, "page": page_number}
+                )
+
+
+def iter_chunk_batches(pages, text_splitter, batch_size=INGEST_BATCH_SIZE,
+                       page_filter=None, chunk_filter=None):
+    """
+    Split pages as they arrive and group the chunks into bounded batches.
+
+    Args:
+        pages (iterable): Page documents, typically from iter_pdf_pages
+        text_splitter: Splitter used to chunk each page
+        batch_size (int): Maximum number of chunks per batch
+        page_filter (callable): Optional; pages for which it returns False
+            are not split
+        chunk_filter (callable): Optional; chunks for which it returns False
+            are dropped from the batches
+
+    Yields:
+        list: Up to batch_size chunk documents
+    """
+    batch = []
+    for page in pages:
+        if page_filter is not None and not page_filter(page):
+            continue
+        chunks = text_splitter.split_documents([page])
+        if chunk_filter is not None:
+            chunks = [chunk for chunk in chunks if chunk_filter(chunk)]
+        batch.extend(chunks)
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+
+def new_stage_stats():
+    """Return an empty per-stage throughput report."""
+    return {
+        "stages": {},
+        "wall_seconds": 0.0
+    }
+
+
+def record_stage(stats, stage, items, seconds, unit):
+    """Add processed items and busy time to a stage in the report."""
+    entry = stats["stages"].setdefault(stage, {"items": 0, "seconds": 0.0, "unit": unit})
+    entry["items"] += items
+    entry["seconds"] += seconds
+
+
+def format_throughput_report(stats):
+    """
+    Format a per-stage throughput report.
+
+    Args:
+        stats (dict): Report returned by run_ingestion_pipeline
+
+    Returns:
+        str: One line per stage plus the total wall time
+    """
+    lines = []
+    for stage, entry in stats["stages"].items():
+        rate = entry["items"] / entry["seconds"] if entry["seconds"] > 0 else 0.0
+        lines.append(
+            f"{stage}: {entry['items']} {entry['unit']} in {entry['seconds']:.2f}s "
+            f"({rate:.1f} {entry['unit']}/s)"
+        )
+    lines.append(f"wall time: {stats['wall_seconds']:.2f}s")
+    return "\n".join(lines)
+
+
+def _run_stage(name, work, errors):
+    """Run a stage body in a thread, recording the first error raised."""
+    def target():
+        try:
+            work()
+        except BaseException as e:
+            errors.append((name, e))
+
+    thread = threading.Thread(target=target, name=f"ingest-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+def _put(out_queue, item, stop_events):
+    """Put onto a bounded queue, giving up if the pipeline is stopping."""
+    while not any(event.is_set() for event in stop_events):
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(in_queue, stop_events):
+    """Get from a queue, returning _DONE if the pipeline is stopping."""
+    while not any(event.is_set() for event in stop_events):
+        try:
+            return in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def run_ingestion_pipeline(file_paths, text_splitter, embeddings, index_batch,
+                           workers=INGEST_WORKERS, batch_size=INGEST_BATCH_SIZE,
+                           queue_size=INGEST_QUEUE_SIZE, page_filter=None, chunk_filter=None,
+                           progress=None, cancel_event=None):
+    """
+    Ingest PDFs through overlapping extract, split, embed and index stages.
+
+    Pages are extracted in a process pool while splitting and embedding run
+    on their own threads; stages hand work to each other through bounded
+    queues. index_batch is called on the calling thread as soon as each
+    batch of vectors is ready.
+
+    Args:
+        file_paths (str or list): Path or paths of PDFs on disk
+        text_splitter: Splitter used to chunk each page
+        embeddings: Embedding model with embed_documents, or an EncodingPool
+        index_batch (callable): Called as index_batch(docs, vectors)
+        workers (int): Number of extraction processes
+        batch_size (int): Chunks per embedding batch
+        queue_size (int): Capacity of each inter-stage queue
+        page_filter (callable): Optional page predicate, see iter_chunk_batches
+        chunk_filter (callable): Optional chunk predicate, see iter_chunk_batches
+        progress (callable): Optional; called as progress(stage, items) each
+            time pages are extracted or chunks are indexed
+        cancel_event (threading.Event): Optional; setting it stops every
+            stage and makes the pipeline raise IngestionCancelled
+
+    Returns:
+        dict: Per-stage throughput report
+    """
+    stats = new_stage_stats()
+    errors = []
+    stop_event = threading.Event()
+    stop_events = (stop_event,) if cancel_event is None else (stop_event, cancel_event)
+    page_queue = queue.Queue(maxsize=queue_size * batch_size)
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    vector_queue = queue.Queue(maxsize=queue_size)
+    wall_start = time.perf_counter()
+
+    def extract():
+        try:
+            pages = iter_pdf_pages_parallel(file_paths, workers)
+            while True:
+                start = time.perf_counter()
+                page = next(pages, _DONE)
+                if page is _DONE:
+                    break
+                record_stage(stats, "extract", 1, time.perf_counter() - start, "pages")
+                if progress is not None:
+                    progress("extract", 1)
+                if not _put(page_queue, page, stop_events):
+                    break
+            pages.close()
+        finally:
+            _put(page_queue, _DONE, stop_events)
+
+    def split():
+        try:
+            def pages():
+                while True:
+                    page = _get(page_queue, stop_events)
+                    if page is _DONE:
+                        return
+                    yield page
+
+            batches = iter_chunk_batches(pages(), text_splitter, batch_size, page_filter, chunk_filter)
+            while True:
+                start = time.perf_counter()
+                batch = next(batches, _DONE)
+                if batch is _DONE:
+                    break
+                record_stage(stats, "split", len(batch), time.perf_counter() - start, "chunks")
+                if not _put(chunk_queue, batch, stop_events):
+                    break
+        finally:
+            _put(chunk_queue, _DONE, stop_events)
+
+    def embed():
+        # Encoders with submit_documents (EncodingPool) get several batches in
+        # flight at once; others encode one batch at a time
+        submit = getattr(embeddings, "submit_documents", None)
+        max_in_flight = getattr(embeddings, "workers", 1) if submit else 1
+        in_flight = collections.deque()
+        last_done = [0.0]
+
+        def forward_oldest():
+            batch, pending, submitted = in_flight.popleft()
+            vectors = pending.result() if submit else pending
+            # Batches overlap, so each one only adds the time since the
+            # previous one finished: the stage's busy wall-clock time
+            done = time.perf_counter()
+            record_stage(stats, "embed", len(batch), done - max(submitted, last_done[0]), "chunks")
+            last_done[0] = done
+            return _put(vector_queue, (batch, vectors), stop_events)
+
+        try:
+            while True:
+                batch = _get(chunk_queue, stop_events)
+                if batch is _DONE:
+                    break
+                texts = [doc.page_content for doc in batch]
+                start = time.perf_counter()
+                pending = submit(texts) if submit else embeddings.embed_documents(texts)
+                in_flight.append((batch, pending, start))
+                if len(in_flight) >= max_in_flight and not forward_oldest():
+                    break
+            while in_flight and forward_oldest():
+                pass
+        finally:
+            _put(vector_queue, _DONE, stop_events)
+
+    threads = [
+        _run_stage("extract", extract, errors),
+        _run_stage("split", split, errors),
+        _run_stage("embed", embed, errors),
+    ]
+
+    try:
+        while True:
+            item = _get(vector_queue, stop_events)
+            if item is _DONE:
+                break
+            batch, vectors = item
+            start = time.perf_counter()
+            index_batch(batch, vectors)
+            record_stage(stats, "index", len(batch), time.perf_counter() - start, "chunks")
+            if progress is not None:
+                progress("index", len(batch))
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        # Release any upstream stage still blocked on a full queue
+        if errors:
+            stop_event.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        stage, error = errors[0]
+        raise RuntimeError(f"Ingestion failed in {stage} stage: {str(error)}")
+
+    if cancel_event is not None and cancel_event.is_set():
+        raise IngestionCancelled("Ingestion was cancelled")
+
+    stats["wall_seconds"] = time.perf_counter() - wall_start
+    return stats
@@ -0,0 +1,508 @@
+import sys
+import os
+import json
+from collections import Counter
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+LEXICAL_FORMAT_VERSION = 2
+HEADER_FILE = "header.json"
+ARRAYS = ("terms", "term_offsets", "term_indptr", "post_docs", "post_tfs", "doc_len")
+
+# Appended segments kept before they are merged
+MAX_SEGMENTS = 8
+
+# Queries scored per sparse product in top_k_batch
+QUERY_BLOCK_SIZE = 64
+
+
+def _encode_terms(terms):
+    encoded = [term.encode("utf-8") for term in terms]
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return blob, np.cumsum([0] + [len(term) for term in encoded], dtype=np.int64)
+
+
+def _decode_terms(blob, offsets):
+    data = blob.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+def top_k_by_score(positions, scores, k):
+    """
+    Return the k highest-scoring positions and their scores, best first.
+
+    Equal scores go to the lower position, also at the k-th place: every
+    candidate tied with the k-th best score is ranked before truncating.
+    """
+    if len(scores) > k:
+        # Everything scoring at least the k-th best, including all its ties
+        kth_score = -np.partition(-scores, k - 1)[k - 1]
+        best = np.flatnonzero(scores >= kth_score)
+        positions, scores = positions[best], scores[best]
+    order = np.lexsort((positions, -scores))[:k]
+    return positions[order], scores[order]
+
+
+class _Segment:
+    """Postings of a run of chunks, grouped by term id (CSR arrays)."""
+
+    def __init__(self, term_indptr, post_docs, post_tfs):
+        self.term_indptr = term_indptr
+        self.post_docs = post_docs
+        self.post_tfs = post_tfs
+
+    @classmethod
+    def build(cls, term_ids, doc_ids, tfs, term_count):
+        """Group (term, chunk, tf) postings by term; the stable sort keeps each list in chunk order."""
+        order = np.argsort(term_ids, kind="stable")
+        term_indptr = np.zeros(term_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=term_count), out=term_indptr[1:])
+        return cls(term_indptr, doc_ids[order].astype(np.int32), tfs[order].astype(np.int32))
+
+    def __len__(self):
+        return len(self.post_docs)
+
+    def postings(self, term):
+        if term + 1 >= len(self.term_indptr):
+            return self.post_docs[:0], self.post_tfs[:0]
+        start, end = self.term_indptr[term], self.term_indptr[term + 1]
+        return self.post_docs[start:end], self.post_tfs[start:end]
+
+    def expand(self):
+        """Return the (term id, chunk, tf) postings as flat arrays, by term."""
+        term_ids = np.repeat(np.arange(len(self.term_indptr) - 1), np.diff(self.term_indptr))
+        return term_ids, np.asarray(self.post_docs), np.asarray(self.post_tfs)
+
+
+class BM25Index:
+    """
+    Okapi BM25 over an inverted index, touching only the postings of query terms.
+
+    Postings are stored per term as sorted chunk positions and term
+    frequencies (CSR arrays). Scores are those of rank_bm25's BM25Okapi,
+    including its idf floor for terms found in more than half of the chunks.
+
+    top_k prunes with MaxScore: query terms are processed by decreasing
+    upper bound, and once the bounds of the remaining terms cannot lift an
+    unseen chunk into the top k, those terms (typically the frequent ones,
+    with the longest postings) are only looked up for the current candidates.
+
+    The index is updated in place as chunks are added and removed. Added
+    chunks are tokenized into a new segment of postings, and document
+    frequencies, lengths and bounds are updated from that segment alone;
+    segments are merged once there are more than MAX_SEGMENTS. Removing
+    chunks filters and renumbers the postings arrays without re-tokenizing
+    and decrements document frequencies by the removed postings only; the
+    MaxScore bounds are left as they were, which keeps them upper bounds.
+    The idf of every term depends on the corpus size, so it is recomputed
+    on the first search after a change rather than on every change.
+    """
+
+    def __init__(self, terms, segments, doc_len, k1=1.5, b=0.75, epsilon=0.25):
+        self.terms = list(terms)
+        self.vocabulary = {term: i for i, term in enumerate(self.terms)}
+        self.segments = list(segments)
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.total_len = int(doc_len.sum())
+        self._count_terms()
+        self._idf = None
+
+    @classmethod
+    def from_texts(cls, texts, **params):
+        """Index texts tokenized by whitespace, in order; position i is the i-th text."""
+        index = cls([], [], np.array([], dtype=np.int32), **params)
+        index.add(texts)
+        return index
+
+    @property
+    def corpus_size(self):
+        return len(self.doc_len)
+
+    @property
+    def avgdl(self):
+        return self.total_len / self.corpus_size if self.corpus_size else 0.0
+
+    @property
+    def idf(self):
+        if self._idf is None:
+            self._idf = self._compute_idf()
+        return self._idf
+
+    def _tokenize(self, texts):
+        """Turn texts into postings for chunks numbered from the current corpus size."""
+        doc_len = []
+        term_ids = []
+        doc_ids = []
+        tfs = []
+        for doc_id, text in enumerate(texts, start=self.corpus_size):
+            tokens = text.split()
+            doc_len.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                term_id = self.vocabulary.get(term)
+                if term_id is None:
+                    term_id = self.vocabulary[term] = len(self.terms)
+                    self.terms.append(term)
+                term_ids.append(term_id)
+                doc_ids.append(doc_id)
+                tfs.append(count)
+        return (
+            np.array(term_ids, dtype=np.int64), np.array(doc_ids, dtype=np.int64),
+            np.array(tfs, dtype=np.int32), np.array(doc_len, dtype=np.int32)
+        )
+
+    def _grow_terms(self):
+        """Extend the per-term arrays to new vocabulary entries."""
+        added = len(self.terms) - len(self.df)
+        if added:
+            self.df = np.concatenate([self.df, np.zeros(added, dtype=np.int64)])
+            self.max_tf = np.concatenate([self.max_tf, np.zeros(added, dtype=np.int32)])
+            self.min_len = np.concatenate([self.min_len, np.zeros(added, dtype=np.int32)])
+
+    def _count_terms(self):
+        """Compute document frequencies and MaxScore bound inputs from all postings."""
+        self.df = np.zeros(len(self.terms), dtype=np.int64)
+        # A posting weighs most with a high term frequency in a short chunk
+        self.max_tf = np.zeros(len(self.terms), dtype=np.int32)
+        self.min_len = np.zeros(len(self.terms), dtype=np.int32)
+        for segment in self.segments:
+            self._count_postings(*segment.expand())
+
+    def _count_postings(self, term_ids, doc_ids, tfs):
+        new = self.df[term_ids] == 0
+        np.add.at(self.df, term_ids, 1)
+        np.maximum.at(self.max_tf, term_ids, tfs)
+        lengths = self.doc_len[doc_ids]
+        # A term seen for the first time has no minimum length yet
+        first_seen = np.unique(term_ids[new])
+        self.min_len[first_seen] = np.iinfo(np.int32).max
+        np.minimum.at(self.min_len, term_ids, lengths)
+
+    def _compute_idf(self):
+        """Compute the idf of every term from the document frequencies."""
+        present = self.df > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            idf = np.log(self.corpus_size - self.df + 0.5) - np.log(self.df + 0.5)
+        average_idf = idf[present].mean() if present.any() else 0.0
+        idf[idf < 0] = self.epsilon * average_idf
+        return idf
+
+    def add(self, texts):
+        """
+        Append chunks at the end of the index, in order.
+
+        Only the new texts are tokenized; document frequencies, lengths and
+        bounds are updated from their postings.
+        """
+        term_ids, doc_ids, tfs, lengths = self._tokenize(texts)
+        if not len(lengths):
+            return
+        self.doc_len = np.concatenate([self.doc_len, lengths])
+        self.total_len += int(lengths.sum())
+        self._grow_terms()
+        self._count_postings(term_ids, doc_ids, tfs)
+        self.segments.append(_Segment.build(term_ids, doc_ids, tfs, len(self.terms)))
+        if len(self.segments) > MAX_SEGMENTS:
+            # Merge the appended segments, and into the first one once they are as large
+            tail = self._merge(self.segments[1:])
+            if len(tail) >= len(self.segments[0]):
+                self.segments = [self._merge([self.segments[0], tail])]
+            else:
+                self.segments = [self.segments[0], tail]
+        self._idf = None
+
+    def remove(self, positions):
+        """
+        Remove the chunks at the given positions; later chunks move down, as in the vector store.
+
+        Postings are filtered and renumbered in place of re-tokenizing, and
+        document frequencies are decremented by the removed postings.
+        """
+        positions = np.unique(np.asarray(positions, dtype=np.int64))
+        if not len(positions):
+            return
+        keep = np.ones(self.corpus_size, dtype=bool)
+        keep[positions] = False
+        renumber = np.cumsum(keep) - 1
+
+        segments = []
+        for segment in self.segments:
+            term_ids, doc_ids, tfs = segment.expand()
+            kept = keep[doc_ids]
+            np.subtract.at(self.df, term_ids[~kept], 1)
+            if kept.any():
+                term_indptr = np.zeros(len(segment.term_indptr), dtype=np.int64)
+                np.cumsum(np.bincount(term_ids[kept], minlength=len(term_indptr) - 1), out=term_indptr[1:])
+                segments.append(_Segment(term_indptr, renumber[doc_ids[kept]].astype(np.int32), tfs[kept]))
+        self.segments = segments
+        self.total_len -= int(self.doc_len[positions].sum())
+        self.doc_len = self.doc_len[keep]
+        self._idf = None
+
+    def _merge(self, segments):
+        parts = [segment.expand() for segment in segments]
+        # Segments cover increasing chunk positions, so the stable sort keeps postings sorted
+        return _Segment.build(
+            np.concatenate([term_ids for term_ids, _, _ in parts]),
+            np.concatenate([doc_ids for _, doc_ids, _ in parts]),
+            np.concatenate([tfs for _, _, tfs in parts]),
+            len(self.terms)
+        )
+
+    def _postings(self, term):
+        parts = [segment.postings(term) for segment in self.segments]
+        parts = [(docs, tfs) for docs, tfs in parts if len(docs)]
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.array([], dtype=np.int32), np.array([], dtype=np.int32)
+        return np.concatenate([docs for docs, _ in parts]), np.concatenate([tfs for _, tfs in parts])
+
+    def _weights(self, tfs, lengths):
+        tfs = tfs.astype(np.float64)
+        return tfs * (self.k1 + 1) / (tfs + self.k1 * (1 - self.b + self.b * lengths / self.avgdl))
+
+    def top_k(self, query_tokens, k, doc_ids=None):
+        """
+        Return the k best-scoring chunks for a tokenized query.
+
+        Args:
+            query_tokens (list): Query terms; a repeated term counts once per
+                occurrence, as in BM25Okapi
+            k (int): Number of chunks to return
+            doc_ids (array): Optional sorted chunk positions to restrict to
+
+        Returns:
+            tuple: (positions, scores) arrays, best first; only chunks
+            containing a query term are returned
+        """
+        query = [
+            (self.vocabulary[term], count) for term, count in Counter(query_tokens).items()
+            if term in self.vocabulary
+        ]
+        if not query or not self.corpus_size or k <= 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        allowed = None
+        if doc_ids is not None:
+            allowed = np.zeros(self.corpus_size, dtype=bool)
+            allowed[doc_ids] = True
+
+        bounds = np.array([
+            count * self.idf[term] * self._weights(self.max_tf[term:term + 1], self.min_len[term:term + 1])[0]
+            for term, count in query
+        ])
+        # Pruning needs non-negative contributions
+        can_prune = bool((bounds >= 0).all())
+        remaining = bounds.sum()
+
+        candidates = np.array([], dtype=np.int64)
+        scores = np.array([], dtype=np.float64)
+        closed = False
+        for i in np.argsort(-bounds, kind="stable"):
+            term, count = query[i]
+            remaining = max(remaining - bounds[i], 0.0)
+            docs, tfs = self._postings(term)
+
+            if not closed:
+                if allowed is not None:
+                    mask = allowed[docs]
+                    docs, tfs = docs[mask], tfs[mask]
+                contributions = count * self.idf[term] * self._weights(tfs, self.doc_len[docs])
+                candidates, inverse = np.unique(np.concatenate([candidates, docs]), return_inverse=True)
+                scores = np.bincount(inverse, weights=np.concatenate([scores, contributions]),
+                                     minlength=len(candidates))
+            elif len(docs) and len(candidates):
+                # Binary-search the candidates in the postings instead of scanning them
+                slots = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+                hits = docs[slots] == candidates
+                hit_docs = candidates[hits]
+                scores[hits] += count * self.idf[term] * self._weights(tfs[slots[hits]], self.doc_len[hit_docs])
+
+            if can_prune and len(candidates) > k:
+                # Scores only grow, so the current k-th best is a lower bound for the final one
+                threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+                if remaining < threshold:
+                    closed = True
+                if closed:
+                    keep = scores + remaining >= threshold
+                    candidates, scores = candidates[keep], scores[keep]
+
+        return top_k_by_score(candidates, scores, k)
+
+    def scores_at(self, query_tokens, positions):
+        """
+        Return the BM25 scores of a tokenized query for the chunks at the given positions.
+
+        Each query term's postings are binary-searched for the positions, so
+        chunks outside a top_k result can be scored without scoring all of them.
+
+        Returns:
+            array: One score per position, 0 for chunks without a query term
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        scores = np.zeros(len(positions))
+        if not len(positions) or not self.corpus_size:
+            return scores
+        for term, count in Counter(query_tokens).items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            docs, tfs = self._postings(term_id)
+            if not len(docs):
+                continue
+            slots = np.minimum(np.searchsorted(docs, positions), len(docs) - 1)
+            hits = docs[slots] == positions
+            scores[hits] += count * self.idf[term_id] * self._weights(tfs[slots[hits]], self.doc_len[positions[hits]])
+        return scores
+
+    def _term_weights(self, term_ids):
+        """Terms x chunks CSR matrix of BM25 weights (idf included) of the given terms."""
+        from scipy.sparse import csr_matrix
+
+        term_indptr = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        doc_parts, weight_parts = [], []
+        for i, term in enumerate(term_ids):
+            docs, tfs = self._postings(term)
+            doc_parts.append(docs)
+            weight_parts.append(self.idf[term] * self._weights(tfs, self.doc_len[docs]))
+            term_indptr[i + 1] = term_indptr[i] + len(docs)
+        docs = np.concatenate(doc_parts) if doc_parts else np.array([], dtype=np.int32)
+        weights = np.concatenate(weight_parts) if weight_parts else np.array([], dtype=np.float64)
+        return csr_matrix((weights, docs, term_indptr), shape=(len(term_ids), self.corpus_size))
+
+    def top_k_batch(self, queries_tokens, k, doc_ids=None):
+        """
+        Return the k best-scoring chunks of many tokenized queries at once.
+
+        Queries are scored in blocks of QUERY_BLOCK_SIZE, each with one
+        sparse product of a queries x terms count matrix and a terms x
+        chunks weight matrix built from the postings of that block's terms
+        only, instead of one top_k call per query. Only one block's scores
+        are held at a time.
+
+        Args:
+            queries_tokens (list): Query term lists
+            k (int): Number of chunks per query
+            doc_ids (array): Optional sorted chunk positions to restrict to
+
+        Returns:
+            list: (positions, scores) arrays per query, best first, as top_k
+        """
+        from scipy.sparse import csr_matrix
+
+        allowed = None
+        if doc_ids is not None:
+            allowed = np.zeros(self.corpus_size, dtype=bool)
+            allowed[doc_ids] = True
+
+        results = []
+        for block_start in range(0, len(queries_tokens), QUERY_BLOCK_SIZE):
+            block = queries_tokens[block_start:block_start + QUERY_BLOCK_SIZE]
+            rows, term_ids, counts = [], [], []
+            for row, query_tokens in enumerate(block):
+                for term, count in Counter(query_tokens).items():
+                    if term in self.vocabulary:
+                        rows.append(row)
+                        term_ids.append(self.vocabulary[term])
+                        counts.append(count)
+            if not rows or not self.corpus_size or k <= 0:
+                results.extend((np.array([], dtype=np.int64), np.array([], dtype=np.float64)) for _ in block)
+                continue
+
+            terms, columns = np.unique(np.array(term_ids, dtype=np.int64), return_inverse=True)
+            query_matrix = csr_matrix(
+                (np.array(counts, dtype=np.float64), (np.array(rows, dtype=np.int64), columns)),
+                shape=(len(block), len(terms))
+            )
+            weights = self._term_weights(terms)
+            scores = (query_matrix @ weights).tocsr()
+            matches = None
+            if (self.idf[terms] <= 0).any():
+                # A sparse product drops sums of 0, which only a term with a
+                # non-positive idf can produce; the chunks containing a query
+                # term then come from a product with the term presence
+                presence = csr_matrix((np.ones(weights.nnz), weights.indices, weights.indptr), shape=weights.shape)
+                matches = (query_matrix @ presence).tocsr()
+                dense = np.zeros(self.corpus_size)
+
+            for row in range(len(block)):
+                start, end = scores.indptr[row], scores.indptr[row + 1]
+                candidates, row_scores = scores.indices[start:end].astype(np.int64), scores.data[start:end]
+                if matches is not None:
+                    dense[candidates] = row_scores
+                    candidates = matches.indices[matches.indptr[row]:matches.indptr[row + 1]].astype(np.int64)
+                    row_scores = dense[candidates]
+                    dense[candidates] = 0
+                if allowed is not None:
+                    mask = allowed[candidates]
+                    candidates, row_scores = candidates[mask], row_scores[mask]
+                results.append(top_k_by_score(candidates, row_scores, k))
+        return results
+
+    def save(self, path):
+        """
+        Write the index to a directory as flat arrays instead of a pickle.
+
+        Segments are merged into one first. Terms are stored once, as one
+        UTF-8 blob with offsets.
+        """
+        self.segments = [self._merge(self.segments)]
+        segment = self.segments[0]
+        blob, offsets = _encode_terms(self.terms)
+        arrays = {
+            "terms": blob,
+            "term_offsets": offsets,
+            "term_indptr": segment.term_indptr,
+            "post_docs": segment.post_docs,
+            "post_tfs": segment.post_tfs,
+            "doc_len": self.doc_len
+        }
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(arrays[name]))
+
+        header = {
+            "version": LEXICAL_FORMAT_VERSION,
+            "chunks": self.corpus_size,
+            "k1": self.k1,
+            "b": self.b,
+            "epsilon": self.epsilon
+        }
+        # Written last: a directory without a header is incomplete
+        with open(os.path.join(path, HEADER_FILE), "w", encoding="utf-8") as f:
+            json.dump(header, f, indent=2)
+
+    @classmethod
+    def load(cls, path, expected_chunks=None):
+        """
+        Load an index written by save(); postings are memory-mapped.
+
+        Args:
+            path (str): Directory written by save()
+            expected_chunks (int): Number of chunks in the vector store; an
+                index over a different number of chunks is rejected
+
+        Returns:
+            BM25Index: The index, or None if it is missing, from another
+            format version or does not match the store
+        """
+        header_path = os.path.join(path, HEADER_FILE)
+        if not os.path.exists(header_path):
+            return None
+        with open(header_path, encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("version") != LEXICAL_FORMAT_VERSION:
+            return None
+        if expected_chunks is not None and header["chunks"] != expected_chunks:
+            return None
+
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        return cls(
+            _decode_terms(arrays["terms"], arrays["term_offsets"]),
+            [_Segment(arrays["term_indptr"], arrays["post_docs"], arrays["post_tfs"])], np.array(arrays["doc_len"]),
+            k1=header["k1"], b=header["b"], epsilon=header["epsilon"]
+        )
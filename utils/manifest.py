@@ -0,0 +1,104 @@
+import sys
+import os
+import json
+import hashlib
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config.config import MANIFEST_PATH
+
+MANIFEST_VERSION = 2
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_document_id(document_name):
+    """Build the stable id of a document from its file name."""
+    return hash_text(document_name)[:16]
+
+
+def make_chunk_id(document_id, page, text):
+    """
+    Build a deterministic chunk id from its document, page and content.
+
+    Identical chunks always get the same id, so re-ingesting a document
+    can tell which chunks are already in the vector store.
+    """
+    return hash_text(f"{document_id}\x00{page}\x00{text}")
+
+
+def new_manifest():
+    return {"version": MANIFEST_VERSION, "documents": {}}
+
+
+def new_document_entry(name, sha256):
+    return {"name": name, "sha256": sha256, "ingested_at": time.time(), "pages": {}, "chunks": {}}
+
+
+def select_chunk_ids(manifest, document_ids=None, pages=None, uploaded_after=None, uploaded_before=None):
+    """
+    Find the chunks matching a retrieval filter.
+
+    Args:
+        manifest (dict): Loaded manifest
+        document_ids (list): Only chunks of these documents
+        pages (tuple): (first, last) page numbers, 1-based and inclusive,
+            as shown to users; either may be None for an open range
+        uploaded_after (float): Only documents ingested at or after this Unix time
+        uploaded_before (float): Only documents ingested before this Unix time
+
+    Returns:
+        list: Ids of the matching chunks
+    """
+    first, last = pages or (None, None)
+    chunk_ids = []
+    for document_id, entry in manifest["documents"].items():
+        if document_ids is not None and document_id not in document_ids:
+            continue
+        # Documents ingested before upload times were recorded count as oldest
+        ingested_at = entry.get("ingested_at", 0)
+        if uploaded_after is not None and ingested_at < uploaded_after:
+            continue
+        if uploaded_before is not None and ingested_at >= uploaded_before:
+            continue
+        for chunk_id, page_key in entry["chunks"].items():
+            page = int(page_key) + 1
+            if (first is None or page >= first) and (last is None or page <= last):
+                chunk_ids.append(chunk_id)
+    return chunk_ids
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """
+    Load the ingestion manifest.
+
+    The manifest maps each document id to its name, file hash, the content
+    hash of every page and the ids of the chunks stored for it. It is the
+    source of truth for which documents the knowledge base holds.
+
+    Args:
+        path (str): Manifest location
+
+    Returns:
+        dict: Manifest, empty if missing or unreadable
+    """
+    try:
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                return manifest
+    except Exception as e:
+        print(f"Error loading manifest: {str(e)}")
+    return new_manifest()
+
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    """Write the manifest atomically so a crash never leaves it half written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
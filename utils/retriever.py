@@ -1,89 +1,311 @@
 import sys
 import os
+import json
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from config.config import RETRIEVAL_K
+import numpy as np
 
+from config.config import (
+    RETRIEVAL_K, FAISS_CANDIDATES, BM25_CANDIDATES, FUSION_METHOD, FUSION_WEIGHTS, RRF_K,
+    RERANK_ENABLED, RERANK_CANDIDATES, RERANK_TOP_N, MMR_ENABLED, MMR_CANDIDATES, MMR_LAMBDA
+)
+from models.reranker import get_reranker
+from utils.context_builder import pack_context, get_context_budget
+from utils.manifest import load_manifest, select_chunk_ids
+from utils.lexical_index import top_k_by_score
 
-def hybrid_retrieve(query, vectorstore, bm25_index, corpus_docs, k=RETRIEVAL_K):
+
+def resolve_filters(vectorstore, filters):
+    """
+    Resolve a retrieval filter to the chunks it selects, cached on the store.
+
+    Args:
+        vectorstore (ShardedFAISS): Store to search
+        filters (dict): Keyword arguments of select_chunk_ids: document_ids,
+            pages, uploaded_after and/or uploaded_before
+
+    Returns:
+        ChunkSelection: Positions of the selected chunks
+    """
+    key = json.dumps(filters, sort_keys=True, default=sorted)
+    selection = vectorstore.selections.get(key)
+    if selection is None:
+        selection = vectorstore.select_chunks(select_chunk_ids(load_manifest(), **filters))
+        vectorstore.cache_selection(key, selection)
+    return selection
+
+
+FUSION_METHODS = ("weighted", "rrf")
+
+
+def _normalized_scores(faiss_distances, bm25_scores):
+    """Scale FAISS similarity and BM25 scores to at most 1 by the best result of each retriever."""
+    faiss_similarity = np.zeros(len(faiss_distances))
+    if len(faiss_distances) and faiss_distances.max() > 0:
+        faiss_similarity = 1 - faiss_distances / faiss_distances.max()
+    bm25_weight = np.zeros(len(bm25_scores))
+    if len(bm25_scores):
+        bm25_weight = bm25_scores / (bm25_scores.max() if bm25_scores.max() > 0 else 1)
+    return faiss_similarity, bm25_weight
+
+
+def _reciprocal_ranks(count, rrf_k):
+    """RRF score of the results of one retriever, given best first."""
+    return 1.0 / (rrf_k + np.arange(1, count + 1))
+
+
+def fuse_scores(faiss_positions, faiss_distances, bm25_positions, bm25_scores, k=RETRIEVAL_K,
+                method=FUSION_METHOD, weights=FUSION_WEIGHTS, rrf_k=RRF_K):
+    """
+    Blend FAISS and BM25 results into one ranking, keyed by corpus position.
+
+    "weighted" sums the scores of each retriever normalized by its best
+    result; "rrf" sums 1 / (rrf_k + rank) per retriever, ignoring score
+    scales. Either way each retriever's share is scaled by its weight, and a
+    chunk found by one retriever only gets nothing from the other. Ties go
+    to the lower position, also at the k-th place (see top_k_by_score).
+
+    Args:
+        faiss_positions (array): Corpus positions found by FAISS, closest first
+        faiss_distances (array): Their distances
+        bm25_positions (array): Corpus positions found by BM25, best first
+        bm25_scores (array): Their BM25 scores
+        k (int): Number of chunks to return
+        method (str): "weighted" or "rrf"
+        weights (dict): Weight of "faiss" and "bm25"
+        rrf_k (int): Rank offset for "rrf"
+
+    Returns:
+        tuple: (positions, scores) arrays, best first
+    """
+    if method == "weighted":
+        faiss_part, bm25_part = _normalized_scores(faiss_distances, bm25_scores)
+    elif method == "rrf":
+        faiss_part = _reciprocal_ranks(len(faiss_positions), rrf_k)
+        bm25_part = _reciprocal_ranks(len(bm25_positions), rrf_k)
+    else:
+        raise ValueError(f"Unknown fusion method: {method} (expected one of {', '.join(FUSION_METHODS)})")
+
+    # Sum the two scores of each chunk found by both retrievers
+    candidates, inverse = np.unique(np.concatenate([faiss_positions, bm25_positions]), return_inverse=True)
+    combined = np.bincount(
+        inverse,
+        weights=np.concatenate([weights["faiss"] * faiss_part, weights["bm25"] * bm25_part]),
+        minlength=len(candidates)
+    )
+
+    return top_k_by_score(candidates, combined, k)
+
+
+def mmr_select(vectors, relevance, k, lambda_mult=MMR_LAMBDA):
+    """
+    Pick k rows by maximal marginal relevance.
+
+    Each step takes the candidate with the best lambda_mult * relevance
+    minus (1 - lambda_mult) * its highest cosine similarity to the rows
+    already picked, so near-duplicate chunks (such as neighbours sharing
+    CHUNK_OVERLAP characters) are not all kept.
+
+    Args:
+        vectors (array): Candidate vectors, one row each
+        relevance (array): Candidate relevance, best about 1
+        k (int): Number of rows to pick
+        lambda_mult (float): 1 ranks by relevance only, 0 by diversity only
+
+    Returns:
+        array: Indices of the picked rows, in picking order
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms > 0, norms, 1)
+
+    picked = []
+    # Nothing is picked yet, so nothing is redundant
+    max_similarity = np.zeros(len(vectors))
+    for step in range(min(k, len(vectors))):
+        mmr = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        mmr[picked] = -np.inf
+        best = int(np.argmax(mmr))
+        picked.append(best)
+        # Only the similarities to the newly picked row are computed each step
+        similarity = vectors @ vectors[best]
+        max_similarity = similarity if step == 0 else np.maximum(max_similarity, similarity)
+    return np.array(picked, dtype=np.int64)
+
+
+def _with_faiss_hit_scores(bm25_index, query_tokens, faiss_positions, bm25_result):
+    """Add the BM25 scores of FAISS hits outside the BM25 results, so they are not fused as 0."""
+    bm25_positions, bm25_scores = bm25_result
+    missing = np.setdiff1d(faiss_positions, bm25_positions)
+    scores = bm25_index.scores_at(query_tokens, missing)
+    found = scores > 0
+    return (
+        np.concatenate([bm25_positions, missing[found]]),
+        np.concatenate([bm25_scores, scores[found]])
+    )
+
+
+def _rank(vectorstore, faiss_result, bm25_result, k, fusion, weights, rrf_k, mmr):
+    """Fuse the results of one query into k corpus positions, diversified with MMR if asked."""
+    faiss_distances, faiss_positions = faiss_result
+    bm25_positions, bm25_scores = bm25_result
+    positions, scores = fuse_scores(
+        faiss_positions, faiss_distances, bm25_positions, bm25_scores,
+        max(k, MMR_CANDIDATES) if mmr else k, method=fusion, weights=weights, rrf_k=rrf_k
+    )
+    if mmr and len(positions) > k:
+        # The fused score is the relevance, scaled so both fusion methods weigh alike
+        relevance = scores / scores[0] if scores[0] > 0 else scores
+        positions = positions[mmr_select(vectorstore.vectors_at(positions), relevance, k)]
+    return positions
+
+
+def _no_bm25_results():
+    return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+
+def hybrid_retrieve(query, vectorstore, bm25_index, corpus_docs, k=RETRIEVAL_K, filters=None,
+                    faiss_candidates=FAISS_CANDIDATES, bm25_candidates=BM25_CANDIDATES, fusion=FUSION_METHOD,
+                    weights=FUSION_WEIGHTS, rrf_k=RRF_K, mmr=MMR_ENABLED):
+    """
+    Retrieve the k chunks that best match a query, by FAISS and BM25.
+
+    Each retriever fetches its own pool of candidates (at least k), so a
+    good keyword match can also carry a semantic score when it is outside
+    FAISS's top k, and the pools are fused with fuse_scores (fusion,
+    weights and rrf_k are passed on to it). For weighted fusion, FAISS hits
+    outside the BM25 pool are scored by BM25 as well, so every chunk keeps
+    its full keyword score; rrf only ranks the pools.
+    With mmr, the k chunks are picked from the best MMR_CANDIDATES fused
+    ones with mmr_select, using the vectors stored in the index.
+    """
     if not vectorstore:
         return []
     
     try:
-        # FAISS semantic search
-        faiss_docs = vectorstore.similarity_search_with_score(query, k=k)
-        
+        # Restrict both searches to the filtered chunks up front, so all k
+        # results match the filter
+        selection = resolve_filters(vectorstore, filters) if filters else None
+        if selection is not None and not len(selection):
+            return []
+
+        pool = max(k, MMR_CANDIDATES) if mmr else k
+        use_bm25 = bool(bm25_index and corpus_docs)
+
+        # FAISS semantic search, as corpus positions
+        embedding = vectorstore.embeddings.embed_query(query)
+        faiss_result = vectorstore.search_positions(
+            embedding, k=max(pool, faiss_candidates) if use_bm25 else pool, selection=selection
+        )
+
         # BM25 keyword search
-        if bm25_index and corpus_docs:
+        if use_bm25:
             query_tokens = query.lower().split()
-            bm25_scores = bm25_index.get_scores(query_tokens)
-            
-            # Normalize scores
-            max_bm25 = max(bm25_scores) if max(bm25_scores) > 0 else 1
-            max_faiss = max([score for _, score in faiss_docs]) if faiss_docs else 1
-            
-            # Create score dictionary
-            doc_scores = {}
-            
-            # Add BM25 scores
-            for doc, score in zip(corpus_docs, bm25_scores):
-                doc_content = doc.page_content
-                doc_scores[doc_content] = {
-                    "bm25": score / max_bm25,
-                    "faiss": 0,
-                    "doc": doc
-                }
-            
-            # Add FAISS scores
-            for doc, score in faiss_docs:
-                doc_content = doc.page_content
-                faiss_similarity = 1 - (score / max_faiss) if max_faiss > 0 else 0
-                
-                if doc_content in doc_scores:
-                    doc_scores[doc_content]["faiss"] = faiss_similarity
-                else:
-                    doc_scores[doc_content] = {
-                        "bm25": 0,
-                        "faiss": faiss_similarity,
-                        "doc": doc
-                    }
-            
-            # Calculate combined scores (60% FAISS, 40% BM25)
-            for content in doc_scores:
-                doc_scores[content]["combined"] = (
-                    0.4 * doc_scores[content]["bm25"] +
-                    0.6 * doc_scores[content]["faiss"]
-                )
-            
-            # Sort by combined score
-            ranked_docs = sorted(
-                doc_scores.values(),
-                key=lambda x: x["combined"],
-                reverse=True
-            )
-            
-            return [item["doc"] for item in ranked_docs[:k]]
-        
-        return [doc for doc, _ in faiss_docs[:k]]
+            doc_ids = selection.corpus_positions if selection is not None else None
+            bm25_result = bm25_index.top_k(query_tokens, max(pool, bm25_candidates), doc_ids=doc_ids)
+            if fusion == "weighted":
+                bm25_result = _with_faiss_hit_scores(bm25_index, query_tokens, faiss_result[1], bm25_result)
+        else:
+            bm25_result = _no_bm25_results()
+            corpus_docs = vectorstore.documents()
+
+        # Fuse on integer positions; only the k results are loaded from the docstore
+        positions = _rank(vectorstore, faiss_result, bm25_result, k, fusion, weights, rrf_k, mmr)
+        return [corpus_docs[int(position)] for position in positions]
     
     except Exception as e:
         print(f"Error during retrieval: {str(e)}")
         return []
 
 
-def retrieve_context(query, vectorstore, bm25_index, corpus_docs, k=RETRIEVAL_K):
+def hybrid_retrieve_batch(queries, vectorstore, bm25_index, corpus_docs, k=RETRIEVAL_K, filters=None,
+                          faiss_candidates=FAISS_CANDIDATES, bm25_candidates=BM25_CANDIDATES,
+                          fusion=FUSION_METHOD, weights=FUSION_WEIGHTS, rrf_k=RRF_K, mmr=MMR_ENABLED):
+    """
+    Run hybrid_retrieve for many queries at once, for evaluation and bulk answering.
+
+    All queries are embedded in one call, searched with one FAISS search per
+    shard and scored by BM25 with sparse matrix products over blocks of
+    queries; only the fusion runs per query.
+
+    Args:
+        queries (list): Query strings
+        filters (dict): Optional scope applied to every query, see resolve_filters
+
+    Returns:
+        list: The retrieved chunks of each query, in the order of queries
+    """
+    if not vectorstore or not queries:
+        return [[] for _ in queries]
+
+    try:
+        selection = resolve_filters(vectorstore, filters) if filters else None
+        if selection is not None and not len(selection):
+            return [[] for _ in queries]
+
+        pool = max(k, MMR_CANDIDATES) if mmr else k
+        use_bm25 = bool(bm25_index and corpus_docs)
+
+        embeddings = vectorstore.embeddings.embed_documents(list(queries))
+        faiss_results = vectorstore.search_positions_batch(
+            embeddings, k=max(pool, faiss_candidates) if use_bm25 else pool, selection=selection
+        )
+
+        if use_bm25:
+            doc_ids = selection.corpus_positions if selection is not None else None
+            queries_tokens = [query.lower().split() for query in queries]
+            bm25_results = bm25_index.top_k_batch(queries_tokens, max(pool, bm25_candidates), doc_ids=doc_ids)
+            if fusion == "weighted":
+                bm25_results = [
+                    _with_faiss_hit_scores(bm25_index, query_tokens, faiss_result[1], bm25_result)
+                    for query_tokens, faiss_result, bm25_result in zip(queries_tokens, faiss_results, bm25_results)
+                ]
+        else:
+            bm25_results = [_no_bm25_results() for _ in queries]
+            corpus_docs = vectorstore.documents()
+
+        results = []
+        for faiss_result, bm25_result in zip(faiss_results, bm25_results):
+            positions = _rank(vectorstore, faiss_result, bm25_result, k, fusion, weights, rrf_k, mmr)
+            results.append([corpus_docs[int(position)] for position in positions])
+        return results
+
+    except Exception as e:
+        print(f"Error during batch retrieval: {str(e)}")
+        return [[] for _ in queries]
+
+
+def retrieve_context(query, vectorstore, bm25_index, corpus_docs, k=RETRIEVAL_K, filters=None,
+                     rerank=RERANK_ENABLED, response_mode="Detailed"):
+    """
+    Retrieve the prompt context for a query.
+
+    Returns:
+        tuple: (context, pages, report) where report is the pack_context
+        report, or None if retrieval failed
+    """
     try:
-        # Retrieve documents
-        docs = hybrid_retrieve(query, vectorstore, bm25_index, corpus_docs, k)
+        if rerank:
+            # Score a wider fused pool with the cross-encoder and keep fewer chunks
+            docs = hybrid_retrieve(query, vectorstore, bm25_index, corpus_docs, max(k, RERANK_CANDIDATES), filters)
+            try:
+                docs = get_reranker().rerank(query, docs, RERANK_TOP_N)
+            except Exception as e:
+                print(f"Error reranking: {str(e)}")
+                docs = docs[:RERANK_TOP_N]
+        else:
+            # Retrieve documents
+            docs = hybrid_retrieve(query, vectorstore, bm25_index, corpus_docs, k, filters)
         
-        # Format context
-        context = "\n\n".join([doc.page_content for doc in docs])
+        # Format context within the token budget of the response mode,
+        # sending the overlap of neighbouring chunks once
+        context, docs, report = pack_context(docs, get_context_budget(response_mode))
         
         # Get page numbers
         pages = sorted(set([doc.metadata.get('page', 0) + 1 for doc in docs[:3]]))
         
-        return context, pages
+        return context, pages, report
     
     except Exception as e:
         print(f"Error retrieving context: {str(e)}")
-        return "", []
+        return "", [], None
@@ -0,0 +1,376 @@
+import sys
+import os
+import json
+import heapq
+import shutil
+import uuid
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config.config import RETRIEVAL_K, VECTOR_INDEX_MMAP, VECTOR_SHARD_SIZE, VECTOR_SEARCH_THREADS
+import numpy as np
+from utils.chunk_store import ChunkSequence
+from utils.vector_index import ConfigurableFAISS, VectorstoreWriter
+
+SHARDS_FILE = "shards.json"
+SHARDS_FORMAT_VERSION = 1
+
+# Resolved filters kept per store
+SELECTION_CACHE_SIZE = 32
+
+# Shared by all stores: FAISS releases the GIL while searching, so shards
+# are searched side by side
+_search_pool = None
+
+
+def _get_search_pool():
+    global _search_pool
+    if _search_pool is None:
+        _search_pool = ThreadPoolExecutor(max_workers=VECTOR_SEARCH_THREADS, thread_name_prefix="shard-search")
+    return _search_pool
+
+
+def _map_shards(func, shards):
+    """Apply func to every shard, in parallel when there is more than one."""
+    if len(shards) < 2:
+        return [func(shard) for shard in shards]
+    return list(_get_search_pool().map(func, shards))
+
+
+def _link_directory(source, destination):
+    """Hard-link the files of a saved shard into a new knowledge base, copying across file systems."""
+    os.makedirs(destination)
+    for name in os.listdir(source):
+        try:
+            os.link(os.path.join(source, name), os.path.join(destination, name))
+        except OSError:
+            shutil.copy2(os.path.join(source, name), os.path.join(destination, name))
+
+
+class ShardedChunkSequence(Sequence):
+    """The chunks of all shards in shard order, fetched from their docstores on access."""
+
+    def __init__(self, shards):
+        self.sequences = [ChunkSequence(shard.docstore, shard.index_to_docstore_id) for shard in shards]
+
+    def __len__(self):
+        return sum(len(sequence) for sequence in self.sequences)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(len(self))[position]]
+        if position < 0:
+            position += len(self)
+        for sequence in self.sequences:
+            if 0 <= position < len(sequence):
+                return sequence[position]
+            position -= len(sequence)
+        raise IndexError(position)
+
+    def __iter__(self):
+        for sequence in self.sequences:
+            yield from sequence
+
+
+class ChunkSelection:
+    """
+    The index positions of a set of chunks, resolved once per filter.
+
+    shard_positions holds the sorted positions within each shard, for the
+    FAISS search; corpus_positions holds the same chunks numbered across all
+    shards, in the order of get_store_documents and the BM25 index.
+    """
+
+    def __init__(self, shard_positions, shard_sizes):
+        self.shard_positions = shard_positions
+        offsets = np.cumsum([0] + list(shard_sizes[:-1]))
+        self.corpus_positions = np.concatenate(
+            [positions + offset for positions, offset in zip(shard_positions, offsets)]
+        )
+
+    def __len__(self):
+        return len(self.corpus_positions)
+
+
+class ShardedFAISS:
+    """
+    Knowledge base split into several ConfigurableFAISS shards.
+
+    New chunks go to the newest shard until it holds VECTOR_SHARD_SIZE
+    chunks, then a new shard is started with its own trained index, so
+    "auto" picks the index type of each shard by that shard's size. Queries
+    are searched on every shard in parallel and the per-shard top-k lists
+    are merged by distance.
+
+    Each shard is saved to its own directory. A shard that was loaded and
+    not changed since is hard-linked into the new save instead of being
+    written again; a changed shard is written under a new name, so a shard
+    directory never changes once written.
+    """
+
+    def __init__(self, embeddings, shards, sources=None):
+        self.embeddings = embeddings
+        self.shards = list(shards)
+        # Directory each unchanged shard was loaded from, None once it changes
+        self.sources = list(sources) if sources is not None else [None] * len(self.shards)
+        # Filter key -> ChunkSelection; positions move when chunks are added or deleted
+        self.selections = {}
+
+    @property
+    def memory_mapped(self):
+        return any(shard.memory_mapped for shard in self.shards)
+
+    def documents(self):
+        """Return the chunks of the knowledge base as a lazily loaded sequence."""
+        return ShardedChunkSequence(self.shards)
+
+    def select_chunks(self, chunk_ids):
+        """Resolve chunk ids to a ChunkSelection; ids not in the store are ignored."""
+        return ChunkSelection(
+            [shard.index_to_docstore_id.positions_of(chunk_ids)[0] for shard in self.shards],
+            [len(shard.index_to_docstore_id) for shard in self.shards]
+        )
+
+    def cache_selection(self, key, selection):
+        if len(self.selections) >= SELECTION_CACHE_SIZE:
+            self.selections.clear()
+        self.selections[key] = selection
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, selection=None, **kwargs):
+        """
+        Search every shard and merge their results.
+
+        Args:
+            selection (ChunkSelection): Optional; only these chunks are
+                searched, inside each shard's index
+        """
+        if selection is None:
+            searches = [(shard, None) for shard in self.shards]
+        else:
+            searches = [
+                (shard, positions)
+                for shard, positions in zip(self.shards, selection.shard_positions) if len(positions)
+            ]
+        results = _map_shards(
+            lambda search: search[0].similarity_search_with_score_by_vector(
+                embedding, k=k, positions=search[1], **kwargs
+            ),
+            searches
+        )
+        # Each shard returns its matches by increasing distance
+        return list(islice(heapq.merge(*results, key=lambda item: item[1]), k))
+
+    def search_positions(self, embedding, k=RETRIEVAL_K, selection=None):
+        """
+        Return the distances and corpus positions of the k nearest chunks, closest first.
+
+        Positions are numbered across shards, as in documents() and the BM25
+        index; no chunk is read from the docstores.
+        """
+        return self.search_positions_batch([embedding], k=k, selection=selection)[0]
+
+    def search_positions_batch(self, embeddings, k=RETRIEVAL_K, selection=None):
+        """search_positions for many query vectors, with one search per shard for all of them."""
+        offsets = np.cumsum([0] + [len(shard.index_to_docstore_id) for shard in self.shards[:-1]])
+        if selection is None:
+            searches = [(shard, None, offset) for shard, offset in zip(self.shards, offsets)]
+        else:
+            searches = [
+                (shard, positions, offset)
+                for shard, positions, offset in zip(self.shards, selection.shard_positions, offsets) if len(positions)
+            ]
+        shard_results = _map_shards(
+            lambda search: search[0].search_positions_batch(embeddings, k=k, positions=search[1]), searches
+        )
+
+        results = []
+        for i in range(len(embeddings)):
+            if not searches:
+                results.append((np.array([], dtype=np.float32), np.array([], dtype=np.int64)))
+                continue
+            distances = np.concatenate([shard_result[i][0] for shard_result in shard_results])
+            positions = np.concatenate([
+                shard_result[i][1] + search[2] for shard_result, search in zip(shard_results, searches)
+            ])
+            order = np.argsort(distances, kind="stable")[:k]
+            results.append((distances[order], positions[order]))
+        return results
+
+    def vectors_at(self, positions):
+        """Return the stored vectors of the chunks at the given corpus positions, in that order."""
+        positions = np.asarray(positions, dtype=np.int64)
+        sizes = [len(shard.index_to_docstore_id) for shard in self.shards]
+        offsets = np.cumsum([0] + sizes)
+        shard_of = np.searchsorted(offsets, positions, side="right") - 1
+        vectors = np.zeros((len(positions), self.shards[0].index.d), dtype=np.float32)
+        for i in np.unique(shard_of):
+            rows = shard_of == i
+            vectors[rows] = self.shards[i].vectors_at(positions[rows] - offsets[i])
+        return vectors
+
+    def similarity_search_with_score(self, query, k=RETRIEVAL_K, **kwargs):
+        embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+
+    def similarity_search(self, query, k=RETRIEVAL_K, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def delete(self, ids=None):
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+
+        missing_ids = set(ids)
+        shard_ids = []
+        for shard in self.shards:
+            _, missing = shard.index_to_docstore_id.positions_of(ids)
+            missing = set(missing)
+            shard_ids.append([chunk_id for chunk_id in ids if chunk_id not in missing])
+            missing_ids &= missing
+        if missing_ids:
+            raise ValueError(
+                f"Some specified ids do not exist in the current store. Ids not found: {sorted(missing_ids)}"
+            )
+
+        self.selections.clear()
+        for i, (shard, chunk_ids) in enumerate(zip(self.shards, shard_ids)):
+            if chunk_ids:
+                shard.delete(chunk_ids)
+                self.sources[i] = None
+
+        kept = [i for i, shard in enumerate(self.shards) if len(shard.index_to_docstore_id)] or [0]
+        self.shards = [self.shards[i] for i in kept]
+        self.sources = [self.sources[i] for i in kept]
+        return True
+
+    def fit_index_to_corpus(self):
+        """
+        Rebuild the index of every shard whose size now calls for another type.
+
+        Returns:
+            dict: measure_index report of a rebuilt shard, or None if none changed
+        """
+        reports = _map_shards(lambda shard: shard.fit_index_to_corpus(), self.shards)
+        for i, report in enumerate(reports):
+            if report:
+                self.sources[i] = None
+        return next((report for report in reversed(reports) if report), None)
+
+    def save_local(self, folder_path):
+        os.makedirs(folder_path, exist_ok=True)
+        names = []
+        for shard, source in zip(self.shards, self.sources):
+            if source is not None and os.path.isdir(source):
+                name = os.path.basename(source)
+                _link_directory(source, os.path.join(folder_path, name))
+            else:
+                name = f"shard-{uuid.uuid4().hex[:12]}"
+                shard.save_local(os.path.join(folder_path, name))
+            names.append(name)
+
+        manifest = {
+            "version": SHARDS_FORMAT_VERSION,
+            "shards": [
+                {"name": name, "chunks": len(shard.index_to_docstore_id)}
+                for name, shard in zip(names, self.shards)
+            ]
+        }
+        with open(os.path.join(folder_path, SHARDS_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, *, allow_dangerous_deserialization=False, mmap=VECTOR_INDEX_MMAP):
+        shards_path = os.path.join(folder_path, SHARDS_FILE)
+        if not os.path.exists(shards_path):
+            # Single-index knowledge base from before sharding; it is
+            # written in the sharded layout on the next save
+            shard = ConfigurableFAISS.load_local(
+                folder_path, embeddings, allow_dangerous_deserialization=allow_dangerous_deserialization, mmap=mmap
+            )
+            return cls(embeddings, [shard])
+
+        with open(shards_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != SHARDS_FORMAT_VERSION:
+            raise ValueError(f"Unsupported shard format version: {manifest.get('version')}")
+
+        sources = [os.path.abspath(os.path.join(folder_path, entry["name"])) for entry in manifest["shards"]]
+        shards = _map_shards(
+            lambda source: ConfigurableFAISS.load_local(
+                source, embeddings, allow_dangerous_deserialization=allow_dangerous_deserialization, mmap=mmap
+            ),
+            sources
+        )
+        return cls(embeddings, shards, sources)
+
+
+class ShardedWriter:
+    """
+    Add embedded chunks to a sharded store, starting new shards as they fill.
+
+    Chunks are appended to the newest shard while it has room; each new
+    shard gets its own VectorstoreWriter, which trains its index on the
+    first vectors of that shard. Chunks appended to the newest shard are
+    searchable as soon as they are added; new shards join the store in
+    finish().
+    """
+
+    def __init__(self, vectorstore, embeddings, shard_size=VECTOR_SHARD_SIZE):
+        self.vectorstore = vectorstore
+        self.embeddings = embeddings
+        self.shard_size = shard_size
+        self.report = None
+        self._writers = []
+        self._appending = False
+
+        last = vectorstore.shards[-1] if vectorstore is not None and vectorstore.shards else None
+        if last is not None and len(last.index_to_docstore_id) < shard_size:
+            self._start(last, len(last.index_to_docstore_id))
+            self._appending = True
+        else:
+            self._start(None, 0)
+
+    def _start(self, shard, count):
+        self._writers.append(VectorstoreWriter(shard, self.embeddings))
+        self._count = count
+
+    def add(self, texts, vectors, metadatas, ids):
+        start = 0
+        while start < len(texts):
+            if self._count >= self.shard_size:
+                self._writers[-1].finish()
+                self._start(None, 0)
+            end = min(len(texts), start + self.shard_size - self._count)
+            self._writers[-1].add(texts[start:end], vectors[start:end], metadatas[start:end], ids[start:end])
+            self._count += end - start
+            start = end
+
+    def finish(self):
+        """Index anything still buffered and return the store (None if nothing was added)."""
+        new_shards = []
+        for i, writer in enumerate(self._writers):
+            shard = writer.finish()
+            if writer.report:
+                self.report = writer.report
+            if i == 0 and self._appending:
+                if writer.added_ids:
+                    self.vectorstore.sources[-1] = None
+            elif shard is not None:
+                new_shards.append(shard)
+
+        if self.vectorstore is not None:
+            self.vectorstore.selections.clear()
+        if new_shards:
+            if self.vectorstore is None:
+                self.vectorstore = ShardedFAISS(self.embeddings, new_shards)
+            else:
+                self.vectorstore.shards.extend(new_shards)
+                self.vectorstore.sources.extend([None] * len(new_shards))
+        return self.vectorstore
+
+    def rollback(self):
+        """Remove everything this writer added; shards it started are dropped."""
+        for writer in self._writers:
+            writer.rollback()
+        self._writers = []
@@ -0,0 +1,877 @@
+import sys
+import os
+import json
+import math
+import pickle
+import tempfile
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from config.config import (
+    RETRIEVAL_K, VECTOR_INDEX_TYPE, VECTOR_STORAGE, VECTOR_PCA_DIM, VECTOR_INDEX_TRAIN_SIZE,
+    VECTOR_INDEX_RECALL_QUERIES, VECTOR_INDEX_HNSW_MIN_VECTORS, VECTOR_INDEX_IVF_MIN_VECTORS,
+    VECTOR_INDEX_IVFPQ_MIN_VECTORS, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH, IVF_NLIST, IVF_NPROBE,
+    PQ_M, PQ_OPQ, PQ_RERANK_FACTOR, VECTOR_INDEX_MMAP
+)
+from utils.chunk_store import SQLiteDocstore, ChunkIdMap, CHUNKS_FILE, CHUNK_IDS_FILE
+
+INDEX_PARAMS_FILE = "index_params.json"
+RERANK_VECTORS_FILE = "rerank_vectors.f16"
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+
+# Layout of stores saved before index specs existed
+EXACT_INDEX_SPEC = {"type": "flat", "auto": False, "storage": "float32", "pca_dim": 0}
+
+# IVF needs about this many training vectors per inverted list
+IVF_MIN_TRAIN_PER_LIST = 39
+
+# PQ learns 256 centroids per sub-quantizer
+PQ_MIN_TRAINING_VECTORS = 256 * IVF_MIN_TRAIN_PER_LIST
+
+# Spec keys whose configured value can only be built once a shard holds
+# enough vectors; the configured values are kept under "requested"
+REQUESTED_KEYS = ("type", "nlist", "pca_dim", "opq")
+
+# An IVF index is retrained once the list count its size calls for is this
+# many times larger (or smaller) than the one it was trained with
+NLIST_REFIT_FACTOR = 2
+
+REBUILD_BATCH_SIZE = 10000
+
+# Filtered HNSW and IVF-PQ searches over at most this many chunks compare
+# them all exactly: graph search finds few matches for a narrow filter
+FILTER_EXACT_MAX_VECTORS = 4096
+
+
+def default_index_spec():
+    """Return the index layout configured for new knowledge bases."""
+    return {
+        "type": VECTOR_INDEX_TYPE,
+        "auto": VECTOR_INDEX_TYPE == "auto",
+        "storage": VECTOR_STORAGE,
+        "pca_dim": VECTOR_PCA_DIM,
+        "hnsw_m": HNSW_M,
+        "ef_construction": HNSW_EF_CONSTRUCTION,
+        "ef_search": HNSW_EF_SEARCH,
+        "nlist": IVF_NLIST,
+        "nprobe": IVF_NPROBE,
+        "pq_m": PQ_M,
+        "opq": PQ_OPQ,
+        "rerank_factor": PQ_RERANK_FACTOR
+    }
+
+
+def select_index_type(vector_count):
+    """Pick the index type for a corpus of this many chunks."""
+    if vector_count >= VECTOR_INDEX_IVFPQ_MIN_VECTORS:
+        return "ivfpq"
+    if vector_count >= VECTOR_INDEX_IVF_MIN_VECTORS:
+        return "ivf"
+    if vector_count >= VECTOR_INDEX_HNSW_MIN_VECTORS:
+        return "hnsw"
+    return "flat"
+
+
+def is_exact_spec(spec):
+    return (
+        spec.get("type", "flat") in ("flat", "auto")
+        and spec.get("storage", "float32") == "float32"
+        and not spec.get("pca_dim")
+    )
+
+
+def default_nlist(vector_count):
+    """IVF list count for a corpus of this many chunks when IVF_NLIST is 0."""
+    return int(4 * math.sqrt(vector_count))
+
+
+def training_sample_size(vector_count):
+    """Vectors to train a rebuilt index on: VECTOR_INDEX_TRAIN_SIZE, or enough for default_nlist lists."""
+    return min(vector_count, max(VECTOR_INDEX_TRAIN_SIZE, IVF_MIN_TRAIN_PER_LIST * default_nlist(vector_count)))
+
+
+def fit_index_spec(spec, vector_count, dimension, training_count=None):
+    """
+    Resolve a spec for the vectors available to build the index from.
+
+    The configured type, nlist, pca_dim and opq are kept under "requested"
+    the first time a spec is resolved, so fit_index_to_corpus can build
+    the configured layout once enough vectors exist.
+
+    "auto" becomes a concrete type for vector_count. A PCA projection needs
+    at least as many training vectors as output dimensions and only makes
+    sense if it reduces the dimension; otherwise it is dropped. The IVF
+    list count defaults to about 4 * sqrt(vector_count), capped so each list
+    gets enough training vectors. IVF-PQ falls back to plain IVF when there
+    are too few vectors to train its codebooks, and uses the largest number
+    of sub-quantizers up to pq_m that divides the dimension.
+    """
+    if training_count is None:
+        training_count = vector_count
+    spec = {**default_index_spec(), **spec}
+    if "requested" not in spec:
+        spec["requested"] = {key: spec[key] for key in REQUESTED_KEYS}
+    if spec["type"] == "auto":
+        spec["type"] = select_index_type(vector_count)
+    if spec["type"] not in INDEX_TYPES:
+        raise ValueError(f"Unknown vector index type: {spec['type']}")
+
+    pca_dim = spec["pca_dim"]
+    if pca_dim and (pca_dim >= dimension or training_count < pca_dim):
+        spec["pca_dim"] = 0
+
+    if spec["type"] == "ivfpq" and training_count < PQ_MIN_TRAINING_VECTORS:
+        spec["type"] = "ivf"
+
+    if spec["type"] in ("ivf", "ivfpq"):
+        nlist = spec["nlist"] or default_nlist(vector_count)
+        spec["nlist"] = max(1, min(nlist, training_count // IVF_MIN_TRAIN_PER_LIST))
+        spec["nprobe"] = min(spec["nprobe"], spec["nlist"])
+
+    if spec["type"] == "ivfpq":
+        # Training the OPQ rotation needs at least as many vectors as dimensions
+        spec["opq"] = spec["opq"] and training_count >= dimension
+        pq_dimension = spec["pca_dim"] or dimension
+        spec["pq_m"] = max(m for m in range(1, spec["pq_m"] + 1) if pq_dimension % m == 0)
+    return spec
+
+
+def index_factory_string(spec, dimension):
+    """Translate a resolved index spec into a faiss.index_factory description."""
+    parts = []
+    index_type = spec.get("type", "flat")
+    reduced_dimension = spec["pca_dim"] if 0 < spec.get("pca_dim", 0) < dimension else 0
+    if index_type == "ivfpq" and spec["opq"]:
+        # The OPQ rotation also does the dimension reduction
+        parts.append(f"OPQ{spec['pq_m']}_{reduced_dimension or dimension}")
+    elif reduced_dimension:
+        parts.append(f"PCA{reduced_dimension}")
+
+    codes = "SQfp16" if spec.get("storage") == "float16" else "Flat"
+    if index_type == "ivfpq":
+        parts.append(f"IVF{spec['nlist']},PQ{spec['pq_m']}")
+    elif index_type == "hnsw":
+        parts.append(f"HNSW{spec['hnsw_m']}" + ("_SQfp16" if codes == "SQfp16" else ""))
+    elif index_type == "ivf":
+        parts.append(f"IVF{spec['nlist']},{codes}")
+    else:
+        parts.append(codes)
+    return ",".join(parts)
+
+
+def _base_index(index):
+    """The index behind any PCA transform, downcast to its concrete type."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def apply_search_params(index, spec):
+    """Set the query-time parameters of a spec (efSearch, nprobe) on an index."""
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = spec["ef_search"]
+    elif isinstance(base, faiss.IndexIVF):
+        base.nprobe = spec["nprobe"]
+
+
+def filtered_search_params(index, spec, positions):
+    """
+    Search parameters that restrict a search to the given index positions.
+
+    Only a fraction of the vectors an approximate index visits pass the
+    filter, so efSearch and nprobe are widened by the inverse of that
+    fraction to still find k matches.
+    """
+    mask = np.zeros(index.ntotal, dtype=bool)
+    mask[positions] = True
+    bitmap = np.packbits(mask, bitorder="little")
+    selector = faiss.IDSelectorBitmap(index.ntotal, faiss.swig_ptr(bitmap))
+    widen = index.ntotal / max(len(positions), 1)
+
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(
+            sel=selector, efSearch=int(min(base.ntotal, math.ceil(spec["ef_search"] * widen)))
+        )
+    elif isinstance(base, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(
+            sel=selector, nprobe=int(min(base.nlist, math.ceil(spec["nprobe"] * widen)))
+        )
+    else:
+        params = faiss.SearchParameters(sel=selector)
+
+    inner = params
+    if isinstance(faiss.downcast_index(index), faiss.IndexPreTransform):
+        params = faiss.SearchParametersPreTransform(index_params=inner)
+    # SWIG does not keep the selector and its bitmap alive
+    params.referenced_objects = [inner, selector, bitmap]
+    return params
+
+
+def create_index(spec, dimension):
+    """
+    Create an empty FAISS index for a resolved spec.
+
+    A PCA projection or OPQ rotation is stored as an IndexPreTransform in
+    front of the vectors, so queries searched through the index are
+    transformed the same way as the documents were.
+    """
+    index = faiss.index_factory(dimension, index_factory_string(spec, dimension), faiss.METRIC_L2)
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efConstruction = spec["ef_construction"]
+    apply_search_params(index, spec)
+    return index
+
+
+def bytes_per_vector(index):
+    """Bytes an index keeps in memory for each vector it holds."""
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        # Vector codes plus the int32 neighbour links of the bottom layer
+        return bytes_per_vector(base.storage) + 4 * base.hnsw.nb_neighbors(0)
+    if isinstance(base, faiss.IndexIVF):
+        # Codes plus the int64 id stored next to each one in its list
+        return base.code_size + 8
+    return base.code_size
+
+
+def read_index(index_path, mmap=VECTOR_INDEX_MMAP):
+    """
+    Read a FAISS index, memory-mapping it read-only if possible.
+
+    FAISS can map the inverted lists of IVF indexes (IVF, IVF-PQ), which
+    hold almost all of their memory: loading then takes constant time and
+    processes on one host share the pages through the OS cache. Other
+    index types, or a failed mapping, fall back to reading into memory.
+
+    Returns:
+        tuple: (index, True if the index is memory-mapped)
+    """
+    if mmap:
+        try:
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            base = _base_index(index)
+            if isinstance(base, faiss.IndexIVF):
+                invlists = faiss.downcast_InvertedLists(base.invlists)
+                return index, isinstance(invlists, faiss.OnDiskInvertedLists)
+            return index, False
+        except RuntimeError as e:
+            print(f"Could not memory-map {index_path}, reading it into memory: {str(e)}")
+    return faiss.read_index(index_path), False
+
+
+def load_into_memory(index):
+    """Copy the memory-mapped inverted lists of an index into memory so it can be modified."""
+    base = _base_index(index)
+    source = base.invlists
+    lists = faiss.ArrayInvertedLists(base.nlist, base.code_size)
+    for list_no in range(base.nlist):
+        size = source.list_size(list_no)
+        if size:
+            lists.add_entries(list_no, size, source.get_ids(list_no), source.get_codes(list_no))
+    base.replace_invlists(lists, True)
+    lists.this.disown()
+    return index
+
+
+def reconstruct_rows(index, rows):
+    """Decode the vectors at the given positions back to the input space."""
+    base = _base_index(index)
+    # Built once; _remove_positions drops it before renumbering
+    if isinstance(base, faiss.IndexIVF) and base.direct_map.type == faiss.DirectMap.NoMap:
+        base.make_direct_map()
+    return index.reconstruct_batch(np.asarray(rows, dtype=np.int64))
+
+
+def _remove_positions(index, positions, spec):
+    """
+    Remove vectors from an index, keeping the positions of the rest dense.
+
+    The store maps index position i to the i-th remaining chunk, as flat
+    indexes do after remove_ids. IVF lists keep their original ids, so they
+    are renumbered in place; HNSW graphs cannot delete and are rebuilt.
+    """
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        keep = np.ones(index.ntotal, dtype=bool)
+        keep[positions] = False
+        return rebuild_index(index, spec, keep)[0]
+
+    if isinstance(base, faiss.IndexIVF):
+        base.set_direct_map_type(faiss.DirectMap.NoMap)
+    index.remove_ids(positions)
+    if isinstance(base, faiss.IndexIVF):
+        invlists = base.invlists
+        for list_no in range(base.nlist):
+            size = invlists.list_size(list_no)
+            if size:
+                ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), size)
+                ids -= np.searchsorted(positions, ids)
+    return index
+
+
+def rebuild_index(index, spec, keep=None, fetch_rows=None):
+    """
+    Copy the vectors of an index into a new one built for spec.
+
+    Vectors keep their order, so store positions stay valid. Vectors of
+    reduced layouts are decoded before re-indexing, which is lossless for
+    float32 and float16 storage and approximate after a PCA projection.
+
+    Args:
+        index: Source index
+        spec (dict): Spec of the new index; "auto" is resolved for its size
+        keep (np.ndarray): Optional boolean mask of rows to copy
+        fetch_rows (callable): Returns the vectors at given positions;
+            defaults to decoding them from the index
+
+    Returns:
+        tuple: (new index, resolved spec, training sample)
+    """
+    if fetch_rows is None:
+        def fetch_rows(positions):
+            return reconstruct_rows(index, positions)
+
+    rows = np.arange(index.ntotal) if keep is None else np.flatnonzero(keep)
+    training_count = training_sample_size(len(rows))
+    spec = fit_index_spec(spec, len(rows), index.d, training_count)
+    new_index = create_index(spec, index.d)
+
+    rng = np.random.default_rng(0)
+    sample_rows = np.sort(rng.choice(rows, size=training_count, replace=False))
+    sample = fetch_rows(sample_rows)
+    if not new_index.is_trained:
+        new_index.train(sample)
+
+    for start in range(0, len(rows), REBUILD_BATCH_SIZE):
+        new_index.add(fetch_rows(rows[start:start + REBUILD_BATCH_SIZE]))
+    return new_index, spec, sample
+
+
+def measure_index(trained_index, spec, vectors, k=RETRIEVAL_K, queries=VECTOR_INDEX_RECALL_QUERIES):
+    """
+    Compare an index layout against an exact float32 search on a sample.
+
+    Args:
+        trained_index: Empty, trained index; it is cloned, not modified
+        spec (dict): Resolved spec of the index
+        vectors (np.ndarray): Sample of document vectors, also used as queries
+        k (int): Neighbours compared per query
+        queries (int): Number of sampled query vectors
+
+    Returns:
+        dict: Memory per vector for both layouts and the recall@k of the index
+    """
+    count, dimension = vectors.shape
+    k = min(k, count)
+    rng = np.random.default_rng(0)
+    query_vectors = vectors[rng.choice(count, size=min(queries, count), replace=False)]
+
+    sample_index = faiss.clone_index(trained_index)
+    sample_index.reset()
+    apply_search_params(sample_index, spec)
+    sample_index.add(vectors)
+    _, approx = sample_index.search(query_vectors, k)
+
+    distances = (
+        np.sum(query_vectors ** 2, axis=1)[:, None]
+        - 2 * query_vectors @ vectors.T
+        + np.sum(vectors ** 2, axis=1)[None, :]
+    )
+    exact = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    recall = np.mean([len(set(a) & set(e)) / k for a, e in zip(approx, exact)])
+
+    report = {
+        "layout": index_factory_string(spec, dimension),
+        "sample_vectors": count,
+        "k": k,
+        "recall_at_k": float(recall),
+        "bytes_per_vector": bytes_per_vector(trained_index),
+        "float32_bytes_per_vector": 4 * dimension
+    }
+
+    if spec.get("type") == "ivfpq":
+        # Re-rank a larger candidate set with the float16 vectors, as searches do
+        _, candidates = sample_index.search(query_vectors, min(k * spec["rerank_factor"], count))
+        stored = vectors.astype(np.float16).astype(np.float32)
+        reranked = []
+        for query, row in zip(query_vectors, candidates):
+            row = row[row >= 0]
+            order = np.argsort(np.sum((stored[row] - query) ** 2, axis=1))[:k]
+            reranked.append(row[order])
+        report["reranked_recall_at_k"] = float(
+            np.mean([len(set(a) & set(e)) / k for a, e in zip(reranked, exact)])
+        )
+    return report
+
+
+def format_index_report(report):
+    """Format a measure_index report as one line."""
+    ratio = report["bytes_per_vector"] / report["float32_bytes_per_vector"]
+    line = (
+        f"Index {report['layout']}: {report['bytes_per_vector']} bytes/vector, "
+        f"{ratio:.0%} of exact float32 ({report['float32_bytes_per_vector']}), "
+        f"recall@{report['k']} {report['recall_at_k']:.3f} on {report['sample_vectors']} sampled vectors"
+    )
+    if "reranked_recall_at_k" in report:
+        line += (
+            f"; compression {1 / ratio:.1f}x, recall@{report['k']} "
+            f"{report['reranked_recall_at_k']:.3f} after exact re-ranking"
+        )
+    return line
+
+
+class RerankVectors:
+    """
+    float16 copies of the indexed vectors, memory-mapped from disk.
+
+    Rows follow index positions and are read only for the candidates of a
+    search, so the full vectors never have to be resident in memory.
+    Vectors added since the last save are appended to a temporary file and
+    deletions only drop entries from the position map; save() writes a
+    compacted file and maps that instead.
+    """
+
+    def __init__(self, dimension, path=None):
+        self.dimension = dimension
+        self._base = None
+        if path and os.path.getsize(path):
+            self._base = np.memmap(path, dtype=np.float16, mode="r").reshape(-1, dimension)
+        self._base_rows = 0 if self._base is None else len(self._base)
+        self._spill = None
+        self._spill_rows = 0
+        self._spill_map = None
+        self._locations = [np.arange(self._base_rows, dtype=np.int64)]
+
+    def __len__(self):
+        return sum(len(block) for block in self._locations)
+
+    def _location_array(self):
+        if len(self._locations) > 1:
+            self._locations = [np.concatenate(self._locations)]
+        return self._locations[0]
+
+    def append(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float16)
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(0, os.SEEK_END)
+        self._spill.write(vectors.tobytes())
+
+        start = self._base_rows + self._spill_rows
+        self._locations.append(np.arange(start, start + len(vectors), dtype=np.int64))
+        self._spill_rows += len(vectors)
+        self._spill_map = None
+
+    def keep(self, mask):
+        """Drop the rows where mask is False."""
+        self._locations = [self._location_array()[mask]]
+
+    def fetch(self, positions):
+        """Return the vectors at the given positions as float32."""
+        locations = self._location_array()[np.asarray(positions, dtype=np.int64)]
+        vectors = np.empty((len(locations), self.dimension), dtype=np.float32)
+
+        in_base = locations < self._base_rows
+        if in_base.any():
+            vectors[in_base] = self._base[locations[in_base]]
+        if not in_base.all():
+            if self._spill_map is None:
+                self._spill.flush()
+                self._spill_map = np.memmap(
+                    self._spill, dtype=np.float16, mode="r", shape=(self._spill_rows, self.dimension)
+                )
+            vectors[~in_base] = self._spill_map[locations[~in_base] - self._base_rows]
+        return vectors
+
+    def save(self, path):
+        """Write the rows in position order to path and map that file from now on."""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            for start in range(0, len(self), REBUILD_BATCH_SIZE):
+                positions = np.arange(start, min(start + REBUILD_BATCH_SIZE, len(self)))
+                f.write(self.fetch(positions).astype(np.float16).tobytes())
+        os.replace(temp_path, path)
+
+        if self._spill is not None:
+            self._spill.close()
+        self.__init__(self.dimension, path)
+
+
+class ConfigurableFAISS(FAISS):
+    """
+    FAISS store that remembers the layout of its index.
+
+    The spec is saved next to the index in index_params.json, so a store
+    loaded from disk reopens with the same index type and search parameters.
+    IVF-PQ stores also keep float16 vectors on disk (RerankVectors): searches
+    fetch rerank_factor times more candidates from the compressed index and
+    return the k closest by exact distance.
+
+    A store loaded with a memory-mapped index is read-only until it is
+    modified or saved; it then copies the index into memory first.
+
+    Chunks are saved to a SQLite docstore (chunks.sqlite) and the position
+    to chunk id mapping to a byte array (chunk_ids.npy) instead of a pickle,
+    so loading does not materialise every Document. Stores saved as a
+    pickle by earlier versions still load and are converted on save.
+    """
+
+    def __init__(self, *args, index_spec=None, rerank_vectors=None, memory_mapped=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not isinstance(self.index_to_docstore_id, ChunkIdMap):
+            self.index_to_docstore_id = ChunkIdMap.from_ids(
+                [chunk_id for _, chunk_id in sorted(self.index_to_docstore_id.items())]
+            )
+        self.index_spec = {**EXACT_INDEX_SPEC, **(index_spec or {})}
+        self.rerank_vectors = rerank_vectors
+        self.memory_mapped = memory_mapped
+        apply_search_params(self.index, self.index_spec)
+
+    def _ensure_writable(self):
+        if self.memory_mapped:
+            self.index = load_into_memory(self.index)
+            self.memory_mapped = False
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        self._ensure_writable()
+        text_embeddings = list(text_embeddings)
+        ids = super().add_embeddings(text_embeddings, metadatas=metadatas, ids=ids, **kwargs)
+        if self.rerank_vectors is not None:
+            self.rerank_vectors.append([vector for _, vector in text_embeddings])
+        return ids
+
+    def _search(self, vector, count, positions=None):
+        """Return the distances and positions of up to count nearest vectors, optionally among positions only."""
+        return self._search_batch(vector, count, positions)[0]
+
+    def _search_batch(self, vectors, count, positions=None):
+        """_search for each row of vectors, with one index search for all of them."""
+        if positions is None:
+            distances, indices = self.index.search(vectors, count)
+        elif len(positions) <= FILTER_EXACT_MAX_VECTORS and (
+            self.rerank_vectors is not None or isinstance(_base_index(self.index), faiss.IndexHNSW)
+        ):
+            if self.rerank_vectors is not None:
+                rows = self.rerank_vectors.fetch(positions)
+            else:
+                rows = self.index.reconstruct_batch(positions)
+            results = []
+            for vector in vectors:
+                distances = np.sum((rows - vector) ** 2, axis=1)
+                order = np.argsort(distances)[:count]
+                results.append((distances[order], positions[order]))
+            return results
+        else:
+            params = filtered_search_params(self.index, self.index_spec, positions)
+            distances, indices = self.index.search(vectors, count, params=params)
+
+        found = indices >= 0
+        return [(distances[i][found[i]], indices[i][found[i]]) for i in range(len(vectors))]
+
+    def search_positions(self, embedding, k=4, positions=None):
+        """
+        Return the distances and index positions of the k nearest chunks, closest first.
+
+        Unlike the similarity_search methods, no chunk is read from the docstore.
+        """
+        return self.search_positions_batch([embedding], k=k, positions=positions)[0]
+
+    def search_positions_batch(self, embeddings, k=4, positions=None):
+        """search_positions for many query vectors, with one index search for all of them."""
+        vectors = np.array(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        if positions is not None:
+            positions = np.asarray(positions, dtype=np.int64)
+            if not len(positions):
+                return [(np.array([], dtype=np.float32), positions) for _ in range(len(vectors))]
+
+        candidates = k
+        if self.rerank_vectors is not None:
+            candidates *= self.index_spec["rerank_factor"]
+        results = []
+        for vector, (distances, found) in zip(vectors, self._search_batch(vectors, candidates, positions)):
+            if self.rerank_vectors is not None:
+                distances = np.sum((self.rerank_vectors.fetch(found) - vector) ** 2, axis=1)
+            order = np.argsort(distances, kind="stable")[:k]
+            results.append((distances[order], found[order]))
+        return results
+
+    def vectors_at(self, positions):
+        """Return the stored vectors of the chunks at the given positions, without re-embedding them."""
+        positions = np.asarray(positions, dtype=np.int64)
+        if self.rerank_vectors is not None:
+            return self.rerank_vectors.fetch(positions)
+        return reconstruct_rows(self.index, positions)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, positions=None,
+                                               **kwargs):
+        """
+        Search the store, optionally only among the chunks at the given positions.
+
+        positions is applied inside the index (an IDSelector, or an exact
+        scan for narrow filters), so all k results come from those chunks.
+        """
+        if positions is None and self.rerank_vectors is None:
+            return super().similarity_search_with_score_by_vector(
+                embedding, k=k, filter=filter, fetch_k=fetch_k, **kwargs
+            )
+        if positions is not None:
+            positions = np.asarray(positions, dtype=np.int64)
+            if not len(positions):
+                return []
+
+        vector = np.array([embedding], dtype=np.float32)
+        candidates = k if filter is None else fetch_k
+        if self.rerank_vectors is not None:
+            candidates *= self.index_spec["rerank_factor"]
+        distances, positions = self._search(vector, candidates, positions)
+
+        if self.rerank_vectors is not None:
+            distances = np.sum((self.rerank_vectors.fetch(positions) - vector) ** 2, axis=1)
+        filter_func = self._create_filter_func(filter) if filter is not None else None
+        score_threshold = kwargs.get("score_threshold")
+
+        docs = []
+        for j in np.argsort(distances):
+            if score_threshold is not None and distances[j] > score_threshold:
+                break
+            doc = self.docstore.search(self.index_to_docstore_id[positions[j]])
+            if filter_func is None or filter_func(doc.metadata):
+                docs.append((doc, distances[j]))
+                if len(docs) == k:
+                    break
+        return docs
+
+    def delete(self, ids=None, **kwargs):
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+
+        positions, missing_ids = self.index_to_docstore_id.positions_of(ids)
+        if missing_ids:
+            raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing_ids}")
+
+        self._ensure_writable()
+        self.index = _remove_positions(self.index, positions, self.index_spec)
+        keep = np.ones(len(self.index_to_docstore_id), dtype=bool)
+        keep[positions] = False
+        if self.rerank_vectors is not None:
+            self.rerank_vectors.keep(keep)
+        self.docstore.delete(ids)
+        self.index_to_docstore_id.keep(keep)
+        return True
+
+    def _requested_spec(self):
+        """The spec as configured, before it was fitted to the vectors available; None if unknown."""
+        requested = self.index_spec.get("requested")
+        if requested is None and self.index_spec.get("auto"):
+            # Stores saved before the requested layout was kept
+            requested = {"type": "auto", "nlist": IVF_NLIST}
+        if requested is None:
+            return None
+        return {**self.index_spec, **requested, "requested": requested}
+
+    def _needs_refit(self, spec):
+        """Whether spec, fitted to the current size, differs enough from the index's layout to rebuild."""
+        current = self.index_spec
+        for key in ("type", "pca_dim", "opq", "pq_m"):
+            if spec.get(key) != current.get(key) and (key != "opq" or spec["type"] == "ivfpq"):
+                return True
+        if spec["type"] in ("ivf", "ivfpq"):
+            ratio = spec["nlist"] / max(current.get("nlist", 1), 1)
+            return ratio >= NLIST_REFIT_FACTOR or ratio <= 1 / NLIST_REFIT_FACTOR
+        return False
+
+    def fit_index_to_corpus(self):
+        """
+        Rebuild the index once the shard's size calls for another layout.
+
+        What can be built depends on the vectors available: "auto" picks
+        the type by size, IVF-PQ needs PQ_MIN_TRAINING_VECTORS and PCA
+        pca_dim training vectors (smaller shards fall back to IVF and to
+        full dimensions), and the IVF list count follows the size. The
+        configured spec is fitted to the current size again, and the index
+        is rebuilt if the layout changes or the list count is off by
+        NLIST_REFIT_FACTOR.
+
+        Returns:
+            dict: measure_index report for the new index, or None if unchanged
+        """
+        requested = self._requested_spec()
+        if requested is None or not self.index.ntotal:
+            return None
+        training_count = training_sample_size(self.index.ntotal)
+        if not self._needs_refit(fit_index_spec(requested, self.index.ntotal, self.index.d, training_count)):
+            return None
+
+        self._ensure_writable()
+        fetch_rows = self.rerank_vectors.fetch if self.rerank_vectors is not None else None
+        index, spec, sample = rebuild_index(self.index, requested, fetch_rows=fetch_rows)
+
+        if spec["type"] != "ivfpq":
+            self.rerank_vectors = None
+        elif self.rerank_vectors is None:
+            rerank_vectors = RerankVectors(index.d)
+            for start in range(0, self.index.ntotal, REBUILD_BATCH_SIZE):
+                positions = np.arange(start, min(start + REBUILD_BATCH_SIZE, self.index.ntotal))
+                rerank_vectors.append(reconstruct_rows(self.index, positions))
+            self.rerank_vectors = rerank_vectors
+
+        self.index = index
+        self.index_spec = {**spec, "auto": spec["requested"]["type"] == "auto"}
+
+        template = faiss.clone_index(index)
+        template.reset()
+        return measure_index(template, spec, sample)
+
+    def save_local(self, folder_path, index_name="index"):
+        # A mapped index would be written as a reference to its current file
+        self._ensure_writable()
+        os.makedirs(folder_path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(folder_path, f"{index_name}.faiss"))
+
+        if not isinstance(self.docstore, SQLiteDocstore):
+            docstore = SQLiteDocstore()
+            docstore.add({chunk_id: self.docstore.search(chunk_id) for chunk_id in self.index_to_docstore_id.values()})
+            self.docstore = docstore
+        self.docstore.save(os.path.join(folder_path, CHUNKS_FILE))
+        self.index_to_docstore_id.save(os.path.join(folder_path, CHUNK_IDS_FILE))
+        legacy_path = os.path.join(folder_path, f"{index_name}.pkl")
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+
+        params = {
+            "spec": self.index_spec,
+            "layout": index_factory_string(self.index_spec, self.index.d),
+            "dimension": self.index.d
+        }
+        with open(os.path.join(folder_path, INDEX_PARAMS_FILE), "w", encoding="utf-8") as f:
+            json.dump(params, f, indent=2)
+        if self.rerank_vectors is not None:
+            self.rerank_vectors.save(os.path.join(folder_path, RERANK_VECTORS_FILE))
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name="index", *,
+                   allow_dangerous_deserialization=False, mmap=VECTOR_INDEX_MMAP, **kwargs):
+        index_spec = None
+        params_path = os.path.join(folder_path, INDEX_PARAMS_FILE)
+        if os.path.exists(params_path):
+            with open(params_path, encoding="utf-8") as f:
+                index_spec = json.load(f)["spec"]
+
+        index, memory_mapped = read_index(os.path.join(folder_path, f"{index_name}.faiss"), mmap)
+
+        chunks_path = os.path.join(folder_path, CHUNKS_FILE)
+        if os.path.exists(chunks_path):
+            docstore = SQLiteDocstore(chunks_path)
+            index_to_docstore_id = ChunkIdMap.load(os.path.join(folder_path, CHUNK_IDS_FILE))
+        else:
+            if not allow_dangerous_deserialization:
+                raise ValueError(
+                    "This knowledge base stores its docstore as a pickle file; pass "
+                    "allow_dangerous_deserialization=True to load one you created yourself"
+                )
+            with open(os.path.join(folder_path, f"{index_name}.pkl"), "rb") as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+
+        store = cls(
+            embeddings, index, docstore, index_to_docstore_id,
+            index_spec=index_spec, memory_mapped=memory_mapped, **kwargs
+        )
+
+        rerank_path = os.path.join(folder_path, RERANK_VECTORS_FILE)
+        if store.index_spec["type"] == "ivfpq" and os.path.exists(rerank_path):
+            store.rerank_vectors = RerankVectors(store.index.d, rerank_path)
+        return store
+
+
+class VectorstoreWriter:
+    """
+    Add embedded chunks to a store, creating its index on first use.
+
+    For a new knowledge base with anything but an exact flat layout, the
+    first VECTOR_INDEX_TRAIN_SIZE vectors are buffered: the index type is
+    resolved and trained (PCA, IVF) on them, and they serve as the sample
+    for the recall and memory report. Exact flat stores are created from the
+    first batch.
+    """
+
+    def __init__(self, vectorstore, embeddings, index_spec=None):
+        self.vectorstore = vectorstore
+        self.embeddings = embeddings
+        self.index_spec = index_spec or default_index_spec()
+        self.added_ids = []
+        self.report = None
+        self._created = False
+        self._pending = []
+        self._pending_count = 0
+
+    def add(self, texts, vectors, metadatas, ids):
+        if self.vectorstore is None and not is_exact_spec(self.index_spec):
+            self._pending.append((texts, vectors, metadatas, ids))
+            self._pending_count += len(texts)
+            if self._pending_count >= VECTOR_INDEX_TRAIN_SIZE:
+                self._create_from_pending()
+            return
+
+        if self.vectorstore is None:
+            sample = np.asarray(vectors, dtype=np.float32)
+            self._create(sample, fit_index_spec(self.index_spec, len(sample), sample.shape[1]))
+        self._add(texts, vectors, metadatas, ids)
+
+    def finish(self):
+        """Index anything still buffered and return the store (None if nothing was added)."""
+        if self._pending:
+            self._create_from_pending()
+        return self.vectorstore
+
+    def rollback(self):
+        """Remove everything this writer added, or drop the store if it created it."""
+        self._pending = []
+        if self._created:
+            self.vectorstore = None
+        elif self.added_ids:
+            self.vectorstore.delete(self.added_ids)
+        self.added_ids = []
+
+    def _create_from_pending(self):
+        pending, self._pending, self._pending_count = self._pending, [], 0
+        sample = np.vstack([np.asarray(vectors, dtype=np.float32) for _, vectors, _, _ in pending])
+        spec = fit_index_spec(self.index_spec, len(sample), sample.shape[1])
+        requested = spec["requested"]
+        if requested["pca_dim"] and not spec["pca_dim"]:
+            print(
+                f"Warning: VECTOR_PCA_DIM={requested['pca_dim']} needs at least that many chunks to train; "
+                f"indexing {len(sample)} chunks at full dimension until the knowledge base grows"
+            )
+        if requested["type"] == "ivfpq" and spec["type"] != "ivfpq":
+            print(
+                f"Warning: IVF-PQ needs {PQ_MIN_TRAINING_VECTORS} chunks to train; "
+                f"indexing {len(sample)} chunks as IVF until the knowledge base grows"
+            )
+
+        index = self._create(sample, spec)
+        if not is_exact_spec(spec):
+            self.report = measure_index(index, spec, sample)
+
+        for texts, vectors, metadatas, ids in pending:
+            self._add(texts, vectors, metadatas, ids)
+
+    def _create(self, sample, spec):
+        index = create_index(spec, sample.shape[1])
+        if not index.is_trained:
+            index.train(sample)
+        rerank_vectors = RerankVectors(sample.shape[1]) if spec["type"] == "ivfpq" else None
+        self.vectorstore = ConfigurableFAISS(
+            self.embeddings, index, SQLiteDocstore(), {}, index_spec=spec, rerank_vectors=rerank_vectors
+        )
+        self._created = True
+        return index
+
+    def _add(self, texts, vectors, metadatas, ids):
+        self.vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+        self.added_ids.extend(ids)